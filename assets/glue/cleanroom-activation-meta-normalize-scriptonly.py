@@ -1,4 +1,7 @@
 import sys
+import json
+import time
+import boto3
 from awsglue.transforms import *
 from awsglue.utils import getResolvedOptions
 from pyspark.context import SparkContext
@@ -21,6 +24,10 @@ spark = glueContext.spark_session
 job = Job(glueContext)
 job.init(args["JOB_NAME"], args)
 
+# optional parameters for uploading directly from the executors, see meta_direct_upload.py
+optional_args = ["JOB_RUN_ID", "outputformat", "directupload", "directuploadtarget", "metaendpoint", "metaapiversion", "eventspersecond", "uploadconcurrency", "configpath"]
+args.update(getResolvedOptions(sys.argv, [arg for arg in optional_args if f"--{arg}" in sys.argv]))
+
 # set parameters
 sourcebucket=str(args["sourcebucket"])
 targetbucket=str(args["targetbucket"])
@@ -94,19 +101,83 @@ normalize_node3 = sparkSqlQuery(
     transformation_ctx="normalize_node3",
 )
 
-# Script generated for node S3 bucket
-TargetS3bucket_node4 = glueContext.getSink(
-    path=f"s3://{targetbucket}/{targettable}/",
-    connection_type="s3",
-    updateBehavior="UPDATE_IN_DATABASE",
-    partitionKeys=[],
-    enableUpdateCatalog=True,
-    transformation_ctx="TargetS3bucket_node4",
-)
-TargetS3bucket_node4.setCatalogInfo(
-    catalogDatabase=targetcatalogdb,
-    catalogTableName=targetcatalogtable,
-)
-TargetS3bucket_node4.setFormat("csv")
-TargetS3bucket_node4.writeFrame(normalize_node3)
+directupload = args.get("directupload", "false").lower() == "true"
+# event ids are derived from the job run, so retried tasks resend the same ids and later runs get new ones
+run_id = args.get("JOB_RUN_ID", f"{args['JOB_NAME']}-{int(time.time())}")
+# csv for the lambda to build events from, or ndjson with one pre-encoded event per line for its byte pump mode
+outputformat = args.get("outputformat", "csv").lower()
+
+def load_meta_config(config_path: str) -> dict:
+    """
+    Loads the json config sections stored under the ssm parameter path, same layout as used by the lambda
+    """
+    ssm = boto3.client("ssm")
+    config = {}
+    for page in ssm.get_paginator("get_parameters_by_path").paginate(Path=config_path, WithDecryption=True):
+        for param in page["Parameters"]:
+            config[param["Name"].split("/")[-1]] = json.loads(param["Value"])
+    return config
+
+if directupload:
+    # sends events from the executors instead of writing csv files for the lambda
+    # meta_direct_upload.py is added to the job with --extra-py-files
+    from meta_direct_upload import upload_partition
+    meta_config = load_meta_config(args.get("configpath", "/dev/cleanroom-uploads/meta/"))
+    target = args.get("directuploadtarget", "conversions")
+    settings = {
+        "endpoint": args.get("metaendpoint", "https://graph.facebook.com"),
+        "api_version": args.get("metaapiversion", "v14.0"),
+        "access_token": meta_config["conversions"]["access_token"],
+        "target": target,
+        "destination_id": meta_config["conversions"]["pixel_id"] if target == "conversions" else meta_config["custom_audience"]["audience_id"],
+        "events_per_second": float(args.get("eventspersecond", "0")),
+        "run_id": run_id,
+    }
+    # at most one task per partition runs at a time, so capping the partitions caps the upload concurrency
+    # whatever number of executors auto scaling adds, the cluster wide rate limit is split over the partitions
+    upload_rdd = normalize_node3.toDF().rdd
+    upload_concurrency = int(args.get("uploadconcurrency", "0")) or sc.defaultParallelism
+    if upload_rdd.getNumPartitions() > upload_concurrency:
+        upload_rdd = upload_rdd.coalesce(upload_concurrency)
+    settings["parallelism"] = upload_rdd.getNumPartitions()
+    partition_results = (
+        upload_rdd
+        .mapPartitionsWithIndex(lambda index, rows: upload_partition(index, (row.asDict() for row in rows), settings))
+        .collect()
+    )
+    # per partition accounting is written back to s3, one json line per partition
+    results_key = f"{targettable}_upload_results/{args['JOB_NAME']}-{int(time.time())}.jsonl"
+    boto3.client("s3").put_object(
+        Bucket=targetbucket,
+        Key=results_key,
+        Body="\n".join(json.dumps(result) for result in partition_results).encode("utf8"),
+    )
+    print(f"sent {sum(result['events_received'] for result in partition_results)} events "
+        f"from {len(partition_results)} partitions, results written to s3://{targetbucket}/{results_key}")
+elif outputformat == "ndjson":
+    # writes gzip compressed event payload lines in wire format, spark names the files part-*.txt.gz
+    from meta_direct_upload import build_conversion_event
+    event_time = int(time.time())
+    payload_lines = normalize_node3.toDF().rdd.map(
+        lambda row: (json.dumps(build_conversion_event(row.asDict(), event_time, run_id), separators=(",", ":")),)
+    )
+    spark.createDataFrame(payload_lines, "value string").write.mode("append").text(
+        f"s3://{targetbucket}/{targettable}/", compression="gzip"
+    )
+else:
+    # Script generated for node S3 bucket
+    TargetS3bucket_node4 = glueContext.getSink(
+        path=f"s3://{targetbucket}/{targettable}/",
+        connection_type="s3",
+        updateBehavior="UPDATE_IN_DATABASE",
+        partitionKeys=[],
+        enableUpdateCatalog=True,
+        transformation_ctx="TargetS3bucket_node4",
+    )
+    TargetS3bucket_node4.setCatalogInfo(
+        catalogDatabase=targetcatalogdb,
+        catalogTableName=targetcatalogtable,
+    )
+    TargetS3bucket_node4.setFormat("csv")
+    TargetS3bucket_node4.writeFrame(normalize_node3)
 job.commit()
@@ -0,0 +1,266 @@
+"""
+Sends normalized audience rows to Meta directly from the Spark partitions of the normalize glue job
+Each executor task batches the rows of its partition, takes its share of the cluster wide rate limit
+and returns the accounting of the partition, which the driver writes back to S3
+Supports the Conversions api (events of a pixel) and Custom Audiences (users of an audience)
+Only the python standard library is used so that partitions can be tested locally against a stand-in endpoint
+    python meta_direct_upload.py --stand-in 8080
+and passing http://localhost:8080 as endpoint
+"""
+import argparse
+import hashlib
+import json
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# columns of the normalize job output
+audience_columns = ["c_customer_id", "c_first_name", "c_last_name", "c_birth_day", "c_birth_month", "c_birth_year",
+    "c_email_address", "ss_net_paid"]
+
+# maximum rows per request of each target
+max_batch_size = {"conversions": 1000, "customaudience": 10000}
+
+# custom audience schema matching build_audience_row
+audience_schema = ["EXTERN_ID", "FN", "LN", "DOBD", "DOBM", "DOBY", "EMAIL"]
+
+# http status codes that are retried with backoff
+retryable_status_codes = {429, 500, 502, 503, 504}
+
+# website event fields, same sample values as the lambda sends, action_source website requires
+# event_source_url and client_user_agent
+event_source_url = "http://jaspers-market.com/product/123"
+client_ip_address = "1.1.1.1"
+client_user_agent = ("Mozilla/5.0 (iPhone; CPU iPhone OS 13_3_1 like Mac OS X) AppleWebKit/605.1.15 "
+    "(KHTML, like Gecko) Version/13.0.5 Mobile/15E148 Safari/604.1")
+fbc = "fb.1.1554763741205.AbCdEfGhIjKlMnOpQrStUvWxYz1234567890"
+fbp = "fb.1.1558571054389.1098115397"
+
+def hash_value(value) -> str:
+    """
+    Returns the SHA-256 hash of a normalized (trimmed, lower case) value, None for empty values
+    """
+    if value is None:
+        return None
+    normalized = str(value).strip().lower()
+    if not normalized:
+        return None
+    return hashlib.sha256(normalized.encode('utf8')).hexdigest()
+
+def format_dob_part(value, width: int) -> str:
+    """
+    Formats a date of birth part as zero padded digits, None for empty values
+    """
+    if value is None:
+        return None
+    return str(int(value)).zfill(width)
+
+def get_event_id(run_id: str, row: dict) -> str:
+    """
+    Returns a deterministic event id of a row within a job run, derived from the run id and the row values
+    Retried tasks resend the same event ids so meta deduplicates them, while the same customer purchasing
+    again in a later run gets a new id. Rows of the normalize job output are unique, it groups by all columns
+    """
+    row_key = json.dumps([row.get(column) for column in audience_columns], default=str)
+    return hashlib.sha256(f"{run_id}:{row_key}".encode('utf8')).hexdigest()[:32]
+
+def build_conversion_event(row: dict, event_time: int, run_id: str) -> dict:
+    """
+    Builds a Conversions api purchase event in wire format from a normalized row
+    The payload matches the one the lambda builds with the sdk in get_user_data and get_events_data,
+    external id is sent as is like the sdk does and list valued fields are wrapped in lists
+    """
+    user_data = {
+        "em": [hash_value(row.get("c_email_address"))],
+        "ln": [hash_value(row.get("c_last_name"))],
+        "fn": [hash_value(row.get("c_first_name"))],
+        "external_id": [row.get("c_customer_id")],
+        # It is recommended to send Client IP and User Agent for Conversions API Events.
+        "client_ip_address": client_ip_address,
+        "client_user_agent": client_user_agent,
+        "fbc": fbc,
+        "fbp": fbp,
+        "dobd": hash_value(format_dob_part(row.get("c_birth_day"), 2)),
+        "dobm": hash_value(format_dob_part(row.get("c_birth_month"), 2)),
+        "doby": hash_value(format_dob_part(row.get("c_birth_year"), 4)),
+    }
+    return {
+        "event_name": "Purchase",
+        "event_time": event_time,
+        "event_source_url": event_source_url,
+        "event_id": get_event_id(run_id, row),
+        "user_data": {key: value for key, value in user_data.items() if value is not None and value != [None]},
+        "custom_data": {
+            "value": float(row.get("ss_net_paid") or 0),
+            "currency": "usd",
+            "contents": [{"id": "product123", "quantity": 1, "delivery_category": "home_delivery"}],
+        },
+        "action_source": "website",
+    }
+
+def build_audience_row(row: dict) -> list:
+    """
+    Builds a Custom Audience user row in the order of audience_schema, external id is sent as is
+    """
+    return [
+        str(row.get("c_customer_id") or ""),
+        hash_value(row.get("c_first_name")) or "",
+        hash_value(row.get("c_last_name")) or "",
+        hash_value(format_dob_part(row.get("c_birth_day"), 2)) or "",
+        hash_value(format_dob_part(row.get("c_birth_month"), 2)) or "",
+        hash_value(format_dob_part(row.get("c_birth_year"), 4)) or "",
+        hash_value(row.get("c_email_address")) or "",
+    ]
+
+class PartitionRateLimiter:
+    """
+    Token bucket of one executor task. The cluster wide rate is split evenly over the partitions of the upload,
+    so the aggregate rate stays under it as long as no more tasks than partitions run at the same time,
+    which holds whatever number of executors auto scaling adds
+    """
+    def __init__(self, cluster_rate: float, parallelism: int):
+        """
+        Construct new PartitionRateLimiter
+        :param cluster_rate: events per second allowed for the whole cluster, 0 disables limiting
+        :param parallelism: number of partitions of the upload, the cap of tasks running at the same time
+        """
+        self.rate = cluster_rate / max(parallelism, 1)
+        self.tokens = 0.0
+        self.last_refill = time.monotonic()
+
+    def acquire(self, tokens: int) -> float:
+        """
+        Blocks until the tokens are available and returns the seconds spent waiting
+        """
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(max(self.rate, tokens), self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        self.tokens -= tokens
+        if self.tokens >= 0:
+            return 0.0
+        wait_time = -self.tokens / self.rate
+        time.sleep(wait_time)
+        return wait_time
+
+class MetaEndpoint:
+    """
+    Minimal Graph api client for the events of a pixel or the users of a custom audience
+    """
+    def __init__(self, base_url: str, api_version: str, access_token: str, target: str, destination_id: str,
+        timeout: int=60, max_attempts: int=3):
+        """
+        Construct new MetaEndpoint
+        :param base_url: graph api url, or the url of a local stand-in for testing
+        :param target: conversions or customaudience
+        :param destination_id: pixel id for conversions, audience id for custom audiences
+        """
+        if not base_url.startswith(("https://", "http://")):
+            raise ValueError(f"Unsupported endpoint {base_url}")
+        if target not in max_batch_size:
+            raise ValueError(f"Unsupported target {target}")
+        edge = "events" if target == "conversions" else "users"
+        self.url = f"{base_url.rstrip('/')}/{api_version}/{destination_id}/{edge}"
+        self.access_token = access_token
+        self.target = target
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+
+    def get_body(self, items: list) -> bytes:
+        """
+        Returns the form encoded request body of a batch of events or audience rows
+        """
+        if self.target == "conversions":
+            params = {"data": json.dumps(items)}
+        else:
+            params = {"payload": json.dumps({"schema": audience_schema, "data": items})}
+        params["access_token"] = self.access_token
+        return urllib.parse.urlencode(params).encode('utf8')
+
+    def send(self, items: list) -> dict:
+        """
+        Sends a batch and returns the response json, throttled and server errors are retried with backoff
+        """
+        body = self.get_body(items)
+        for attempt in range(1, self.max_attempts + 1):
+            request = urllib.request.Request(self.url, data=body, method="POST")
+            try:
+                # url scheme is validated in the constructor
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:  # nosec B310
+                    return json.loads(response.read() or b"{}")
+            except urllib.error.HTTPError as e:
+                if e.code not in retryable_status_codes or attempt == self.max_attempts:
+                    raise
+            time.sleep(2 ** attempt)
+
+def upload_partition(partition_index: int, rows, settings: dict):
+    """
+    Sends the rows of one partition in batches and yields the accounting of the partition
+    Meant for rdd.mapPartitionsWithIndex, rows are dicts keyed by the normalize job output columns
+    :param settings: endpoint, api_version, access_token, target, destination_id, batch_size,
+        events_per_second, parallelism and run_id, the job run the event ids are derived from
+    """
+    target = settings.get("target", "conversions")
+    endpoint = MetaEndpoint(settings["endpoint"], settings.get("api_version", "v14.0"), settings["access_token"],
+        target, settings["destination_id"])
+    batch_size = min(int(settings.get("batch_size") or max_batch_size[target]), max_batch_size[target])
+    rate_limiter = PartitionRateLimiter(float(settings.get("events_per_second") or 0), int(settings.get("parallelism") or 1))
+    result = {"partition": partition_index, "rows": 0, "requests": 0, "failed_requests": 0, "events_received": 0,
+        "failed_rows": 0, "throttled_seconds": 0.0, "errors": []}
+    event_time = int(time.time())
+
+    def flush(batch):
+        result["throttled_seconds"] += rate_limiter.acquire(len(batch))
+        result["requests"] += 1
+        try:
+            response = endpoint.send(batch)
+            result["events_received"] += int(response.get("events_received", response.get("num_received", len(batch))))
+        except Exception as e:
+            result["failed_requests"] += 1
+            result["failed_rows"] += len(batch)
+            # keeps a few messages for troubleshooting without growing the accounting record
+            if len(result["errors"]) < 5:
+                result["errors"].append(str(e)[:500])
+
+    batch = []
+    for row in rows:
+        result["rows"] += 1
+        batch.append(build_conversion_event(row, event_time, settings["run_id"]) if target == "conversions"
+            else build_audience_row(row))
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    result["throttled_seconds"] = round(result["throttled_seconds"], 3)
+    yield result
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Local stand-in of the Graph api edges, accepts every batch and reports the number of items received
+    """
+    def do_POST(self):
+        body = urllib.parse.parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode('utf8'))
+        if "data" in body:
+            response = {"events_received": len(json.loads(body["data"][0])), "fbtrace_id": "stand-in"}
+        else:
+            response = {"num_received": len(json.loads(body["payload"][0])["data"]), "num_invalid_entries": 0}
+        payload = json.dumps(response).encode('utf8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in of the Meta Graph api for testing direct uploads")
+    parser.add_argument("--stand-in", type=int, required=True, metavar="PORT", help="port of the stand-in endpoint")
+    args = parser.parse_args()
+    print(f"stand-in endpoint listening on http://localhost:{args.stand_in}")
+    HTTPServer(("localhost", args.stand_in), StandInHandler).serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,6 @@ set -e
 
 # fb
 mkdir -p ./python
-pip install facebook_business -t ./python
+pip install facebook_business zstandard -t ./python
 zip -r ./layer.zip ./python
 rm -r ./python/
\ No newline at end of file
@@ -3,7 +3,7 @@ Meta Facebook Marketing API integration Lambda code. Uses an AWS Eventbridge eve
 Reads configuration from AWS System Manager parameter store that includes api token
 Optional code to pull from AWS Secrets manager
 Uses Facebook Business Manager SDK to build and send payload to Conversions api
-Can be used as template to send data to other apis as well
+Other apis can be added as sinks fed by the same read and normalize pass, see ConversionSink
 Author: Ranjith Krishnamoorthy
 """
 from array import array
@@ -19,14 +19,31 @@ from facebook_business.adobjects.serverside.event_request import EventRequest
 from facebook_business.adobjects.serverside.user_data import UserData
 from facebook_business.api import FacebookAdsApi
 from facebook_business.api import FacebookRequest as request
+from facebook_business.exceptions import FacebookRequestError
 import base64
 from botocore.exceptions import ClientError
+from botocore.config import Config
 import traceback, json, configparser, boto3
+import io, os, queue, threading, gzip
+import cProfile, pstats, random, sys, tempfile, tracemalloc
+import hashlib, itertools, multiprocessing
+from multiprocessing.connection import wait as wait_connections
+from abc import ABC, abstractmethod
+from collections import Counter, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import awswrangler as wr
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from pandas import DataFrame
+from suppression_index import SuppressionIndex, hash_keys
 
 # Initialize boto3 client at global scope for connection reuse
 client = boto3.client('ssm')
+s3_client = boto3.client('s3')
+sqs_client = boto3.client('sqs')
 
 # location for AWS System Manager Parameter Store parameter entry
 env = 'dev'
@@ -36,6 +53,554 @@ full_config_path = f'/{env}/{app_config_path}/'
 # Initialize app at global scope for reuse across invocations
 app = None
 
+# object size thresholds in bytes used to route incoming objects, set by the cdk stack as lambda environment variables
+# objects up to small_object_max_bytes take the in-lambda fast path, objects from large_object_min_bytes the pipelined
+# path with large_object_workers sender threads
+small_object_max_bytes = int(os.environ.get('ROUTING_SMALL_OBJECT_MAX_BYTES', 1048576))
+large_object_min_bytes = int(os.environ.get('ROUTING_LARGE_OBJECT_MIN_BYTES', 104857600))
+large_object_workers = int(os.environ.get('ROUTING_LARGE_OBJECT_WORKERS', 4))
+
+# compression of source objects inferred from the object key suffix
+compression_suffixes = {'.gz': 'gzip', '.zst': 'zstd'}
+
+# key suffixes of objects holding one pre-encoded event per line, spark text output is named part-*.txt.gz
+ndjson_suffixes = ('.ndjson', '.ndjson.gz', '.ndjson.zst', '.txt.gz')
+
+# pinned dtypes of the audience columns written by the glue job, in the positional order get_user_data expects
+# nullable small ints keep missing date parts without falling back to float64, text is held in arrow buffers
+audience_dtypes = {
+    'c_customer_id': pd.StringDtype('pyarrow'),
+    'c_first_name': pd.StringDtype('pyarrow'),
+    'c_last_name': pd.StringDtype('pyarrow'),
+    'c_birth_day': pd.Int8Dtype(),
+    'c_birth_month': pd.Int8Dtype(),
+    'c_birth_year': pd.Int16Dtype(),
+    'c_email_address': pd.StringDtype('pyarrow'),
+}
+# all columns are parsed as text, so a malformed or out of range date part rejects its row in validation
+# instead of failing the whole object. Date parts are narrowed to audience_dtypes after validation
+audience_parse_dtypes = {column: pd.StringDtype('pyarrow') for column in audience_dtypes}
+audience_arrow_types = {column: pa.string() for column in audience_dtypes}
+arrow_pandas_types = {pa.string(): pd.StringDtype('pyarrow')}
+
+# columns of the glue job output that are not sent, skipped at parse time
+unused_columns = ['ss_net_paid']
+
+# values read as missing by both csv engines
+csv_null_values = ['', 'null', 'none']
+
+# loose email shape check of the pre-send validation, meta does the final normalization
+email_pattern = r'^[^@\s]+@[^@\s]+\.[^@\s]+$'
+
+# suppression indexes downloaded to /tmp, kept with their s3 etag for reuse across invocations
+suppression_index_cache = {}
+
+# test event code sent with every request, remove it in get_event_request and execute_encoded_request for production
+test_event_code = 'TEST72284'
+
+# graph api error codes of rate limits, expired tokens and permissions, these fail the whole batch and are not bisected
+non_bisectable_error_codes = {4, 10, 17, 32, 102, 190, 200, 613, 80004}
+
+# dynamodb table of the shared token buckets, set by the cdk stack as lambda environment variable
+rate_limit_table_name = os.environ.get('RATE_LIMIT_TABLE_NAME', '')
+
+# rate limiters keyed by pixel id, kept across invocations so unused tokens of a claimed block are not lost
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+# CloudWatch namespace for the metrics printed in embedded metric format
+metrics_namespace = 'MetaUploads'
+
+class PreflightFailed(Exception):
+    """
+    Raised when the canary sample of an object fails the preflight thresholds, the object is not uploaded
+    """
+
+class TokenBucket:
+    """
+    Thread safe token bucket used for the rate limit accounting of one destination
+    A rate of 0 disables limiting
+    """
+    def __init__(self, rate: float, capacity: float=None):
+        """
+        Construct new TokenBucket
+        :param rate: tokens added per second
+        :param capacity: maximum tokens that can be accumulated, defaults to one second worth of tokens
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: int) -> float:
+        """
+        Blocks until the tokens are available and takes them. Returns the seconds spent waiting
+        Requests larger than the capacity are allowed once the bucket is full
+        """
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                needed = min(tokens, self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= tokens
+                    return waited
+                wait_time = (needed - self.tokens) / self.rate
+            time.sleep(wait_time)
+            waited += wait_time
+
+class DistributedTokenBucket:
+    """
+    Token bucket shared by all concurrent senders through a DynamoDB item, so that the aggregate rate of
+    all lambda invocations stays under the rate whatever the concurrency
+    Tokens are claimed from the shared item in blocks with optimistic conditional updates and handed out
+    locally, which keeps the DynamoDB calls to one per block instead of one per request
+    Same acquire interface as TokenBucket. endpoint_url allows testing against DynamoDB local
+    """
+    def __init__(self, table_name: str, bucket_key: str, rate: float, capacity: float=None, block_size: int=1000,
+        endpoint_url: str=None):
+        """
+        Construct new DistributedTokenBucket
+        :param table_name: dynamodb table with string partition key bucket_key
+        :param bucket_key: key of the shared bucket, the pixel id or ad account
+        :param rate: tokens added to the shared bucket per second
+        :param capacity: maximum tokens of the shared bucket, defaults to one second worth of tokens
+        :param block_size: tokens claimed from the shared bucket at a time
+        """
+        self.table_name = table_name
+        self.bucket_key = bucket_key
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.block_size = block_size
+        self.local_tokens = 0
+        self.lock = threading.Lock()
+        self.dynamodb = boto3.client('dynamodb', endpoint_url=endpoint_url or None,
+            config=Config(retries={'max_attempts': 5, 'mode': 'standard'}))
+
+    def claim(self, tokens: int) -> tuple:
+        """
+        Claims tokens from the shared bucket, blocking until it holds enough. A claim takes at most capacity tokens
+        Returns the seconds spent waiting and the number of tokens claimed
+        """
+        waited = 0.0
+        tokens = min(tokens, self.capacity)
+        while True:
+            item = self.dynamodb.get_item(
+                TableName=self.table_name,
+                Key={'bucket_key': {'S': self.bucket_key}},
+                ConsistentRead=True,
+            ).get('Item')
+            now = time.time()
+            if item is None:
+                available = self.capacity
+                condition = 'attribute_not_exists(bucket_key)'
+                values = {}
+            else:
+                last_refill = float(item['last_refill']['N'])
+                available = min(self.capacity, float(item['tokens']['N']) + (now - last_refill) * self.rate)
+                condition = 'last_refill = :last_refill'
+                values = {':last_refill': item['last_refill']}
+            if available < tokens:
+                wait_time = (tokens - available) / self.rate
+                time.sleep(wait_time)
+                waited += wait_time
+                continue
+            values.update({':tokens': {'N': repr(available - tokens)}, ':now': {'N': repr(now)}})
+            try:
+                self.dynamodb.update_item(
+                    TableName=self.table_name,
+                    Key={'bucket_key': {'S': self.bucket_key}},
+                    UpdateExpression='SET tokens = :tokens, last_refill = :now',
+                    ConditionExpression=condition,
+                    ExpressionAttributeValues=values,
+                )
+                return waited, tokens
+            except ClientError as e:
+                # another sender updated the bucket first, read it again
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+
+    def acquire(self, tokens: int) -> float:
+        """
+        Takes tokens from the local block, claiming new blocks from the shared bucket when it runs out
+        Only the tokens actually claimed are credited, blocks are capped to the capacity of the shared bucket
+        Returns the seconds spent waiting
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            waited = 0.0
+            while self.local_tokens < tokens:
+                wait_time, claimed = self.claim(max(self.block_size, tokens - self.local_tokens))
+                waited += wait_time
+                self.local_tokens += claimed
+            self.local_tokens -= tokens
+            return waited
+
+class PixelDestination:
+    """
+    Batch buffer, rate limit accounting and results of one pixel id when rows are routed to several destinations
+    """
+    def __init__(self, pixel_id: str, batch_size: int, rate_limiter: TokenBucket):
+        """
+        Construct new PixelDestination
+        :param pixel_id: pixel id or ad account the events are sent to
+        :param batch_size: events per request
+        :param rate_limiter: token bucket of this destination, one token per event
+        """
+        self.pixel_id = pixel_id
+        self.batch_size = batch_size
+        self.rate_limiter = rate_limiter
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.events_sent = 0
+        self.throttled_seconds = 0.0
+        self.responses = []
+
+    def add_events(self, events: list) -> list:
+        """
+        Adds events to the buffer and returns the full batches that are ready to be flushed
+        """
+        with self.lock:
+            self.buffer.extend(events)
+            batches = []
+            while len(self.buffer) >= self.batch_size:
+                batches.append(self.buffer[:self.batch_size])
+                self.buffer = self.buffer[self.batch_size:]
+            return batches
+
+    def drain(self) -> list:
+        """
+        Returns the remaining partial batch and empties the buffer
+        """
+        with self.lock:
+            batch, self.buffer = self.buffer, []
+            return [batch] if batch else []
+
+    def record_response(self, events_count: int, throttled_seconds: float, response: dict) -> None:
+        """
+        Updates the accounting of this destination after a flush
+        """
+        with self.lock:
+            self.requests += 1
+            self.events_sent += events_count
+            self.throttled_seconds += throttled_seconds
+            self.responses.append(response)
+
+    def get_summary(self) -> dict:
+        """
+        Returns the accounting of this destination
+        """
+        return {
+            "requests": self.requests,
+            "events_sent": self.events_sent,
+            "throttled_seconds": round(self.throttled_seconds, 3),
+            "responses": self.responses,
+        }
+
+class ConversionSink(ABC):
+    """
+    Destination fed with the prepared chunks of one read and normalize pass of MetaAWSAMTConnector
+    Each sink has its own batch buffer, sender threads and failure policy, so several sinks are fed concurrently
+    without reading the source object again. Subclasses implement send_batch and are registered in sink_types
+    Settings are read from the sink_<name> config section
+    """
+    def __init__(self, name: str, connector: 'MetaAWSAMTConnector'):
+        """
+        Construct new ConversionSink
+        :param name: sink name as listed in the sinks config section
+        :param connector: connector of the invocation, used for config, rejects and sending
+        """
+        self.name = name
+        self.connector = connector
+        self.section = f"sink_{name}"
+        self.batch_size = self.get_setting('batch_size', 1000)
+        self.max_workers = self.get_setting('max_workers', 2)
+        # raise fails the object on the first failed batch, continue writes the batch to rejects and goes on
+        self.failure_policy = self.get_setting('failure_policy', 'raise')
+        if self.failure_policy not in ('raise', 'continue'):
+            raise ValueError(f"Unsupported failure_policy {self.failure_policy} of sink {name}")
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f"sink-{name}")
+        self.futures = []
+        self.buffer = []
+        self.buffered_rows = 0
+        self.batches = 0
+        self.lock = threading.Lock()
+        self.rows_sent = 0
+        self.failed_rows = 0
+        self.failed_batches = 0
+        self.responses = []
+
+    def get_setting(self, key: str, default):
+        """
+        Returns a setting of this sink converted to the type of the default value
+        """
+        return self.connector.get_config_value_or_default(self.section, key, default)
+
+    @abstractmethod
+    def send_batch(self, batch_id: int, df_batch: DataFrame) -> dict:
+        """
+        Sends one batch of prepared rows and returns the response
+        """
+
+    def flush_batch(self, batch_id: int, df_batch: DataFrame) -> None:
+        """
+        Sends one batch and updates the accounting of this sink according to the failure policy
+        """
+        try:
+            response = self.send_batch(batch_id, df_batch)
+        except Exception as e:
+            if self.failure_policy == 'raise':
+                raise
+            print(f"sink {self.name} failed sending batch {batch_id}: {e}")
+            with self.lock:
+                self.failed_batches += 1
+                self.failed_rows += len(df_batch.index)
+            self.connector.write_rejects(f"sink-{self.name}", batch_id,
+                df_batch.assign(reject_reason=str(e)[:500]).to_json(orient='records', lines=True).encode(),
+                len(df_batch.index))
+            return
+        with self.lock:
+            self.rows_sent += len(df_batch.index)
+            self.responses.append(response)
+
+    def submit(self, df_batch: DataFrame) -> None:
+        """
+        Hands a batch to the sender threads, waits for the oldest batch when max_workers batches are queued
+        """
+        self.futures.append(self.executor.submit(self.flush_batch, self.batches, df_batch))
+        self.batches += 1
+        while len(self.futures) >= self.max_workers * 2:
+            self.futures.pop(0).result()
+
+    def add_chunk(self, df_chunk: DataFrame) -> None:
+        """
+        Adds prepared rows to the buffer and submits the full batches
+        """
+        self.buffer.append(df_chunk)
+        self.buffered_rows += len(df_chunk.index)
+        if self.buffered_rows < self.batch_size:
+            return
+        buffered = pd.concat(self.buffer)
+        while len(buffered.index) >= self.batch_size:
+            self.submit(buffered.iloc[:self.batch_size])
+            buffered = buffered.iloc[self.batch_size:]
+        self.buffer = [buffered]
+        self.buffered_rows = len(buffered.index)
+
+    def close(self) -> dict:
+        """
+        Submits the remaining partial batch, waits for all batches and returns the accounting of this sink
+        """
+        try:
+            if self.buffered_rows:
+                self.submit(pd.concat(self.buffer))
+                self.buffer, self.buffered_rows = [], 0
+            for future in self.futures:
+                future.result()
+        finally:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+        return {
+            "requests": self.batches,
+            "rows_sent": self.rows_sent,
+            "failed_batches": self.failed_batches,
+            "failed_rows": self.failed_rows,
+            "responses": self.responses,
+        }
+
+class MetaCapiSink(ConversionSink):
+    """
+    Sends batches to the Meta Conversions api, the pixel_id setting overrides the conversions pixel id
+    """
+    def send_batch(self, batch_id: int, df_batch: DataFrame) -> dict:
+        pixel_id = self.get_setting('pixel_id', '') or self.connector.get_config_value('conversions', 'pixel_id')
+        event_request = self.connector.get_event_request(self.connector.build_events(batch_id, df_batch), pixel_id)
+        return self.connector.send_event_request(event_request, batch_id)
+
+class S3JsonLinesSink(ConversionSink):
+    """
+    Writes batches as json lines under the s3_prefix setting, keyed by source object, for downstream consumers
+    """
+    def __init__(self, name: str, connector: 'MetaAWSAMTConnector'):
+        super().__init__(name, connector)
+        self.s3_prefix = self.get_setting('s3_prefix', '').rstrip('/')
+        if not self.s3_prefix.startswith('s3://'):
+            raise ValueError(f"s3_prefix of sink {name} must be an s3 uri")
+
+    def send_batch(self, batch_id: int, df_batch: DataFrame) -> dict:
+        bucket, _, prefix = self.s3_prefix[len('s3://'):].partition('/')
+        key = '/'.join(part for part in [prefix, self.connector.source_key, f"{self.name}-batch-{batch_id}.jsonl"] if part)
+        s3_client.put_object(Bucket=bucket, Key=key, Body=df_batch.to_json(orient='records', lines=True).encode())
+        return {"s3_uri": f"s3://{bucket}/{key}", "rows": len(df_batch.index)}
+
+# sink types of the type setting of a sink_<name> config section, add new destinations here
+sink_types = {
+    'meta_capi': MetaCapiSink,
+    's3_jsonl': S3JsonLinesSink,
+}
+
+class InvocationProfiler:
+    """
+    Collects CPU profiles and tracemalloc memory statistics per stage (read, build, send) of one invocation
+    and writes them as artifacts under an s3 prefix keyed by the invocation id
+    mode cprofile uses deterministic cProfile profiles, mode sampling a statistical sampler thread that
+    records collapsed stacks usable for flame graphs. A disabled profiler adds no overhead
+    """
+    def __init__(self, invocation_id: str=None, enabled: bool=False, mode: str='cprofile', memory: bool=False,
+        s3_prefix: str='', sampling_interval: float=0.01):
+        """
+        Construct new InvocationProfiler
+        :param invocation_id: lambda request id used in the artifact keys
+        :param enabled: profiles stages when True
+        :param mode: cprofile or sampling
+        :param memory: takes tracemalloc statistics at the end of each stage when True
+        :param s3_prefix: s3 uri prefix the artifacts are written to
+        :param sampling_interval: seconds between stack samples in sampling mode
+        """
+        self.invocation_id = invocation_id
+        self.enabled = enabled
+        self.mode = mode
+        self.memory = memory
+        self.s3_prefix = s3_prefix.rstrip('/')
+        self.sampling_interval = sampling_interval
+        self.lock = threading.Lock()
+        # cProfile profiles keyed by stage and thread as a profile can only be active in one thread
+        self.profiles = {}
+        self.stage_times = Counter()
+        self.samples = Counter()
+        self.memory_stats = {}
+        # stage currently running in each thread, used by the sampler to attribute stacks
+        self.active_stages = {}
+        self.sampler_thread = None
+        self.sampler_stop = threading.Event()
+        if self.enabled:
+            self.start()
+
+    def start(self) -> None:
+        """
+        Starts memory tracing and the sampler thread as configured
+        """
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.mode == 'sampling':
+            self.sampler_thread = threading.Thread(target=self.sample_stacks, name="meta-profiler", daemon=True)
+            self.sampler_thread.start()
+
+    def sample_stacks(self) -> None:
+        """
+        Samples the stacks of threads running a stage until the profiler is stopped
+        """
+        while not self.sampler_stop.wait(self.sampling_interval):
+            frames = sys._current_frames()
+            for thread_id, stage in list(self.active_stages.items()):
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.samples[(stage, ';'.join(reversed(stack)))] += 1
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Context manager profiling the enclosed code as the given stage
+        """
+        if not self.enabled:
+            yield
+            return
+        thread_id = threading.get_ident()
+        profile = None
+        if self.mode == 'cprofile':
+            with self.lock:
+                profile = self.profiles.setdefault((name, thread_id), cProfile.Profile())
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiler is already active in this thread
+                profile = None
+        self.active_stages[thread_id] = name
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            self.active_stages.pop(thread_id, None)
+            if profile is not None:
+                profile.disable()
+            with self.lock:
+                self.stage_times[name] += elapsed
+                if self.memory:
+                    self.record_memory(name)
+
+    def record_memory(self, name: str) -> None:
+        """
+        Keeps the peak traced memory and the top allocation sites seen at the end of a stage
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        stats = self.memory_stats.get(name)
+        if stats is None or peak >= stats['peak']:
+            top = tracemalloc.take_snapshot().statistics('lineno')[:25]
+            self.memory_stats[name] = {"current": current, "peak": peak, "top": [str(stat) for stat in top]}
+        tracemalloc.reset_peak()
+
+    def get_artifacts(self) -> dict:
+        """
+        Returns artifact file names and their content
+        """
+        artifacts = {}
+        stages = {name for name, thread_id in self.profiles} | {stage for stage, stack in self.samples}
+        for stage in stages:
+            if self.mode == 'cprofile':
+                stats = None
+                for (name, thread_id), profile in self.profiles.items():
+                    if name == stage:
+                        if stats is None:
+                            stats = pstats.Stats(profile)
+                        else:
+                            stats.add(profile)
+                with tempfile.NamedTemporaryFile() as stats_file:
+                    stats.dump_stats(stats_file.name)
+                    artifacts[f"{stage}.pstats"] = stats_file.read()
+                text_report = io.StringIO()
+                stats.stream = text_report
+                stats.sort_stats('cumulative').print_stats(50)
+                artifacts[f"{stage}.txt"] = text_report.getvalue().encode()
+            else:
+                lines = [f"{stack} {count}" for (name, stack), count in self.samples.items() if name == stage]
+                artifacts[f"{stage}.collapsed.txt"] = '\n'.join(lines).encode()
+        for stage, stats in self.memory_stats.items():
+            artifacts[f"{stage}.memory.json"] = json.dumps(stats, indent=4).encode()
+        artifacts["summary.json"] = json.dumps({
+            "invocation_id": self.invocation_id,
+            "mode": self.mode,
+            "stage_seconds": {stage: round(seconds, 3) for stage, seconds in self.stage_times.items()},
+        }, indent=4).encode()
+        return artifacts
+
+    def write_artifacts(self) -> None:
+        """
+        Stops the profiler and writes the artifacts to s3
+        """
+        if not self.enabled:
+            return
+        self.sampler_stop.set()
+        if self.sampler_thread is not None:
+            self.sampler_thread.join()
+        if self.memory:
+            tracemalloc.stop()
+        bucket, _, prefix = self.s3_prefix[len('s3://'):].partition('/')
+        for name, body in self.get_artifacts().items():
+            key = '/'.join(part for part in [prefix, self.invocation_id, name] if part)
+            s3_client.put_object(Bucket=bucket, Key=key, Body=body)
+        print(f"profiling artifacts written to {self.s3_prefix}/{self.invocation_id}/")
+
 class MetaAWSAMTConnector:
     """
     Meta connector with S3 and EventBridge integration
@@ -47,7 +612,14 @@ class MetaAWSAMTConnector:
         """
         self.config = config
         self.source_file_uri = None
+        self.source_bucket = None
+        self.source_key = None
         self.df_terator = None
+        self.profiler = InvocationProfiler()
+        self.reject_counts = Counter()
+        self.suppressed_rows = 0
+        self.suppression_index = None
+        self.suppression_index_loaded = False
 
     @staticmethod
     def get_secret_from_secret_manager(name, region) -> json:
@@ -130,7 +702,7 @@ class MetaAWSAMTConnector:
         return custom_data
     
     @staticmethod
-    def get_events_data(user_data: UserData, custom_data: CustomData, event_id: int) -> Event:
+    def get_events_data(user_data: UserData, custom_data: CustomData, event_id: str) -> Event:
         """
         Builds fb sdk event object
         """
@@ -153,8 +725,10 @@ class MetaAWSAMTConnector:
         event_request = EventRequest(
             events=events,
             pixel_id=pixel_id,
-            test_event_code='TEST72284'
+            test_event_code=test_event_code
         )
+        # the sdk keeps the pixel id private, rate limiting and bisection need it to rebuild requests
+        event_request.pixel_id = pixel_id
         return event_request
 
     @staticmethod
@@ -169,17 +743,17 @@ class MetaAWSAMTConnector:
         return needed_cols_df_chunk
                    
     @staticmethod
-    def format_dob_digits(inpvalue: float, type: str) -> str:
+    def format_dob_digits(inpvalue: int, type: str) -> str:
         """
-        Formats input float value in to two charecter or four charecter string with prefix 0 
+        Formats input integer value in to two charecter or four charecter string with prefix 0 
         for sending date parts to meta api
         """
         if type == 'd':
-            output = dt.datetime.strptime(f'{int(inpvalue)}', '%d').strftime('%d')
+            output = dt.datetime.strptime(f'{inpvalue}', '%d').strftime('%d')
         elif type == 'm':
-            output = dt.datetime.strptime(f'{int(inpvalue)}', '%m').strftime('%m')
+            output = dt.datetime.strptime(f'{inpvalue}', '%m').strftime('%m')
         elif type == 'y':
-            output = dt.datetime.strptime(f'{int(inpvalue)}', '%Y').strftime('%Y')
+            output = dt.datetime.strptime(f'{inpvalue}', '%Y').strftime('%Y')
         else:
             raise InvalidOperation
         return output
@@ -195,6 +769,31 @@ class MetaAWSAMTConnector:
         Returns value of a config key for given section and key from the configuration object
         """
         return self.config[section][key]
+
+    def get_config_value_or_default(self, section, key, default):
+        """
+        Returns value of an optional config key converted to the type of the default value
+        Returns the default value if the section or key is not configured
+        """
+        if not self.config.has_option(section, key):
+            return default
+        if isinstance(default, bool):
+            return self.config.getboolean(section, key)
+        if isinstance(default, int):
+            return self.config.getint(section, key)
+        if isinstance(default, float):
+            return self.config.getfloat(section, key)
+        return self.config.get(section, key)
+
+    def get_pipeline_settings(self) -> dict:
+        """
+        Returns queue depths and sender pool size of the pipelined connector from the optional pipeline config section
+        """
+        return {
+            "read_queue_depth": self.get_config_value_or_default('pipeline', 'read_queue_depth', 2),
+            "encode_queue_depth": self.get_config_value_or_default('pipeline', 'encode_queue_depth', 4),
+            "sender_workers": self.get_config_value_or_default('pipeline', 'sender_workers', 4),
+        }
     
     def set_s3_source_file_uri(self, event) -> str:
         """
@@ -202,6 +801,8 @@ class MetaAWSAMTConnector:
         """
         bucket = event['detail']['bucket']['name']
         folder_path = event['detail']['object']['key']
+        self.source_bucket = bucket
+        self.source_key = folder_path
         self.source_file_uri = f's3://{bucket}/{folder_path}'
         print(f"Reading {self.source_file_uri}")
 
@@ -211,10 +812,12 @@ class MetaAWSAMTConnector:
         """
         # remove formatting of DOB values if input values are already formatted
         # print(row_tuple)
+        # missing values are left out of the user data, the sdk can not normalize or serialize pandas NA
+        row_tuple = [None if pd.isna(value) else value for value in row_tuple]
         user_data = UserData(
             external_id=row_tuple[1],
-            first_name=str(row_tuple[2]),
-            last_name=str(row_tuple[3]),
+            first_name=None if row_tuple[2] is None else str(row_tuple[2]),
+            last_name=None if row_tuple[3] is None else str(row_tuple[3]),
             dobd=self.format_dob_digits(row_tuple[4], 'd'),
             dobm=self.format_dob_digits(row_tuple[5], 'm'),
             doby=self.format_dob_digits(row_tuple[6], 'y'),
@@ -229,62 +832,913 @@ class MetaAWSAMTConnector:
 
         return user_data
     
-    def set_df_iterator(self, limit_rows: int=None, chunksize: int=100, delimeter: str=',', encoding: str='utf8') -> iter:
+    def get_source_compression(self) -> str:
+        """
+        Returns the compression of the source object inferred from the key suffix, None for uncompressed objects
+        """
+        for suffix, compression in compression_suffixes.items():
+            if self.source_key.endswith(suffix):
+                return compression
+        return None
+
+    def open_source_stream(self, compression: str=None, in_memory: bool=False):
+        """
+        Returns a binary file like object of the source s3 object that decompresses incrementally while it is read
+        Without in_memory the object body is streamed from s3, so only the read buffers are held in memory
+        """
+        if in_memory:
+            raw_stream = io.BytesIO(s3_client.get_object(Bucket=self.source_bucket, Key=self.source_key)['Body'].read())
+        else:
+            raw_stream = s3_client.get_object(Bucket=self.source_bucket, Key=self.source_key)['Body']
+        if compression is None:
+            return raw_stream
+        if compression == 'gzip':
+            return gzip.GzipFile(fileobj=raw_stream, mode='rb')
+        if compression == 'zstd':
+            # zstandard is only needed for zstd compressed objects, it is packaged in the lambda layer
+            try:
+                import zstandard
+            except ImportError as e:
+                raise ImportError("zstandard package is needed to read .zst objects, add it to the lambda layer") from e
+            return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw_stream, read_across_frames=True))
+        raise ValueError(f"Unsupported compression {compression}")
+
+    def set_df_iterator(self, limit_rows: int=None, chunksize: int=100, delimeter: str=',', encoding: str='utf8',
+        in_memory: bool=False, compression: str='infer') -> iter:
         """
         Reads data from s3 file object in chunks and saves in the iterator class object
+        in_memory reads the whole object with a single GET request, meant for small objects only
+        compression is inferred from the key suffix by default, .csv.gz and .csv.zst objects are decompressed
+        incrementally as chunks are read
+        Columns are parsed with the pinned audience schema, the reader engine config selects the pyarrow
+        csv reader (default) or the pandas one
         """
-        self.df_terator = wr.s3.read_csv(path=self.source_file_uri, chunksize=chunksize, sep=delimeter, 
-            na_values=['null', 'none'], encoding=encoding, nrows=limit_rows)
-        print("created dataframe iterator")
+        if compression == 'infer':
+            compression = self.get_source_compression()
+        engine = self.get_config_value_or_default('reader', 'engine', 'pyarrow')
+        if engine == 'pyarrow':
+            self.df_terator = self.read_csv_arrow(self.open_source_stream(compression, in_memory), chunksize,
+                delimeter, encoding, limit_rows)
+        elif in_memory or compression is not None:
+            self.df_terator = pd.read_csv(self.open_source_stream(compression, in_memory), chunksize=chunksize,
+                sep=delimeter, na_values=csv_null_values, encoding=encoding, nrows=limit_rows, dtype=audience_parse_dtypes,
+                usecols=lambda column: column not in unused_columns)
+        else:
+            self.df_terator = wr.s3.read_csv(path=self.source_file_uri, chunksize=chunksize, sep=delimeter, 
+                na_values=csv_null_values, encoding=encoding, nrows=limit_rows, dtype=audience_parse_dtypes,
+                usecols=lambda column: column not in unused_columns)
+        print(f"created dataframe iterator with {engine} engine")
+
+    def read_csv_arrow(self, stream, chunksize: int, delimeter: str, encoding: str, limit_rows: int=None):
+        """
+        Yields DataFrame chunks of chunksize rows parsed by the multithreaded pyarrow csv reader
+        Only the audience columns and the destinations routing column are converted, the routing column type
+        is inferred. Row index continues across chunks like the pandas reader
+        """
+        include_columns = list(audience_arrow_types)
+        routing_column = self.get_config_value_or_default('destinations', 'routing_column', '')
+        if routing_column:
+            include_columns.append(routing_column)
+        reader = pacsv.open_csv(
+            pa.PythonFile(stream, mode='r'),
+            read_options=pacsv.ReadOptions(encoding=encoding),
+            parse_options=pacsv.ParseOptions(delimiter=delimeter),
+            convert_options=pacsv.ConvertOptions(column_types=audience_arrow_types, include_columns=include_columns,
+                null_values=csv_null_values, strings_can_be_null=True),
+        )
+        buffered = []
+        buffered_rows = 0
+        rows_read = 0
+        for batch in reader:
+            if limit_rows is not None:
+                batch = batch.slice(0, limit_rows - rows_read - buffered_rows)
+            buffered.append(batch)
+            buffered_rows += batch.num_rows
+            # block sized record batches are regrouped in to chunks of chunksize rows
+            while buffered_rows >= chunksize:
+                table = pa.Table.from_batches(buffered)
+                yield self.arrow_to_df(table.slice(0, chunksize), rows_read)
+                rows_read += chunksize
+                buffered = table.slice(chunksize).to_batches()
+                buffered_rows -= chunksize
+            if limit_rows is not None and rows_read + buffered_rows >= limit_rows:
+                break
+        if buffered_rows:
+            yield self.arrow_to_df(pa.Table.from_batches(buffered), rows_read)
+
+    @staticmethod
+    def arrow_to_df(table: pa.Table, start: int) -> DataFrame:
+        """
+        Converts an arrow table of the csv reader in to a DataFrame with arrow backed string columns
+        """
+        df_chunk = table.to_pandas(types_mapper=arrow_pandas_types.get)
+        df_chunk.index = pd.RangeIndex(start, start + len(df_chunk.index))
+        return df_chunk
     
-    def send_conversion_data(self, chunk_id: int, df_chunk: DataFrame):
+    @staticmethod
+    def rows_to_df(rows: list, index: list=None) -> DataFrame:
         """
-        Sends sample payload to meta facebook marketing conversions api
+        Builds a DataFrame with the audience parse dtypes from row dicts keyed by the glue job output columns
+        :param index: row labels the event ids are derived from, a range index when not set
+        """
+        df_chunk = pd.DataFrame.from_records(rows, columns=list(audience_dtypes)).astype(audience_parse_dtypes)
+        if index is not None:
+            df_chunk.index = pd.Index(index)
+        return df_chunk
+
+    @staticmethod
+    def narrow_dtypes(df_chunk: DataFrame) -> DataFrame:
+        """
+        Converts the date parts of a validated chunk to the pinned nullable small int dtypes
+        Values that do not fit, only left when validation is disabled, become missing
+        """
+        narrowed = {}
+        for column, dtype in audience_dtypes.items():
+            if isinstance(dtype, pd.StringDtype) or column not in df_chunk.columns or df_chunk[column].dtype == dtype:
+                continue
+            value = pd.to_numeric(df_chunk[column], errors='coerce')
+            limits = np.iinfo(dtype.numpy_dtype)
+            fits = (value.between(limits.min, limits.max) & (value % 1 == 0)).fillna(False).astype(bool)
+            narrowed[column] = value.where(fits).astype(dtype)
+        return df_chunk.assign(**narrowed)
+
+    @staticmethod
+    def get_reject_reasons(df_chunk: DataFrame) -> pd.Series:
+        """
+        Validates a chunk column wise and returns the semicolon separated reject reasons of each row,
+        an empty string for valid rows. Uses the same column positions as get_user_data
+        """
+        external_id = df_chunk.iloc[:, 0]
+        email = df_chunk.iloc[:, 6].astype('string').str.strip()
+        current_year = dt.date.today().year
+        checks = {
+            "missing_identifier": external_id.isna() & email.isna(),
+            "invalid_email": email.notna() & ~email.str.match(email_pattern).fillna(False).astype(bool),
+        }
+        # date parts must be whole numbers in range, format_dob_digits raises on anything else
+        for position, name, low, high in [(3, 'birth_day', 1, 31), (4, 'birth_month', 1, 12), (5, 'birth_year', 1900, current_year)]:
+            value = pd.to_numeric(df_chunk.iloc[:, position], errors='coerce')
+            checks[f"invalid_{name}"] = ~(value.between(low, high) & (value % 1 == 0))
+
+        reasons = pd.Series('', index=df_chunk.index, dtype=object)
+        for reason, mask in checks.items():
+            mask = mask.fillna(True).astype(bool)
+            reasons = reasons.mask(mask, reasons + reason + ';')
+        return reasons.str.rstrip(';')
+
+    def validate_conversion_chunk(self, chunk_id: int, df_chunk: DataFrame) -> DataFrame:
+        """
+        Filters out rows that would fail payload building or be rejected by meta
+        Rejected rows are written with their reasons to the reject sink
+        """
+        reasons = self.get_reject_reasons(df_chunk)
+        rejected = reasons != ''
+        if not rejected.any():
+            return df_chunk
+        rejected_df = df_chunk[rejected].assign(reject_reason=reasons[rejected])
+        for reason_list in rejected_df['reject_reason']:
+            self.reject_counts.update(reason_list.split(';'))
+        self.write_rejects('validation', chunk_id, rejected_df.to_json(orient='records', lines=True).encode(),
+            len(rejected_df.index))
+        return df_chunk[~rejected]
+
+    def write_rejects(self, stage: str, chunk_id: int, body: bytes, count: int) -> None:
+        """
+        Writes rejected records as json lines under the rejects s3_prefix, keyed by source object, stage and chunk
+        Rejects are only counted when no prefix is configured
+        """
+        s3_prefix = self.get_config_value_or_default('rejects', 's3_prefix', '').rstrip('/')
+        if not s3_prefix:
+            print(f"{count} records rejected in {stage} of chunk {chunk_id}, rejects s3_prefix is not configured")
+            return
+        bucket, _, prefix = s3_prefix[len('s3://'):].partition('/')
+        file_name = f"{stage}-chunk-{chunk_id}-{time.time_ns()}.jsonl" if chunk_id is not None else f"{stage}-{time.time_ns()}.jsonl"
+        key = '/'.join(part for part in [prefix, self.source_key, file_name] if part)
+        s3_client.put_object(Bucket=bucket, Key=key, Body=body)
+        print(f"{count} records rejected in {stage} of chunk {chunk_id}, written to s3://{bucket}/{key}")
+
+    def get_suppression_index(self) -> SuppressionIndex:
+        """
+        Returns the memory-mapped suppression index of the suppression s3_uri, None if it is not configured
+        The index file is downloaded to /tmp only when its etag changed since the last invocation, the file of
+        the previous etag is removed first so that /tmp holds a single index file per uri
+        """
+        s3_uri = self.get_config_value_or_default('suppression', 's3_uri', '')
+        if not s3_uri:
+            return None
+        bucket, _, key = s3_uri[len('s3://'):].partition('/')
+        etag = s3_client.head_object(Bucket=bucket, Key=key)['ETag']
+        cached = suppression_index_cache.get(s3_uri)
+        if cached is None or cached[0] != etag:
+            if cached is not None:
+                del suppression_index_cache[s3_uri]
+                cached[1].close()
+                if os.path.exists(cached[1].path):
+                    os.remove(cached[1].path)
+            local_path = os.path.join(tempfile.gettempdir(), f"suppression-{etag.strip(chr(34))}.idx")
+            s3_client.download_file(bucket, key, local_path)
+            suppression_index_cache[s3_uri] = (etag, SuppressionIndex(local_path))
+            print(f"loaded suppression index {s3_uri} with {len(suppression_index_cache[s3_uri][1])} keys")
+        return suppression_index_cache[s3_uri][1]
+
+    def suppress_opted_out(self, df_chunk: DataFrame, suppression_index: SuppressionIndex) -> DataFrame:
+        """
+        Filters out rows whose identifier is in the suppression index with one vectorized membership test
+        The identifier column position defaults to the email column of get_user_data
+        """
+        position = self.get_config_value_or_default('suppression', 'column_position', 6)
+        identifiers = df_chunk.iloc[:, position]
+        present = identifiers.notna().to_numpy()
+        suppressed = np.zeros(len(df_chunk.index), dtype=bool)
+        suppressed[present] = suppression_index.contains(hash_keys(identifiers[present].astype(str)))
+        self.suppressed_rows += int(suppressed.sum())
+        return df_chunk[~suppressed]
+
+    def prepare_conversion_chunk(self, chunk_id: int, df_chunk: DataFrame) -> DataFrame:
+        """
+        Extracts required cols and filters out invalid and opted-out rows of a chunk before payload building
+        Date parts of the remaining rows are narrowed to the pinned dtypes
+        """
+        needed_cols_df_chunk = self.get_needed_cols_df_chunk(df_chunk)
+        if self.get_config_value_or_default('validation', 'enabled', True):
+            needed_cols_df_chunk = self.validate_conversion_chunk(chunk_id, needed_cols_df_chunk)
+        if not self.suppression_index_loaded:
+            self.suppression_index = self.get_suppression_index()
+            self.suppression_index_loaded = True
+        if self.suppression_index is not None:
+            needed_cols_df_chunk = self.suppress_opted_out(needed_cols_df_chunk, self.suppression_index)
+        return self.narrow_dtypes(needed_cols_df_chunk)
+
+    def iterate_df_chunks(self):
+        """
+        Yields chunks of the df iterator object, reading each chunk is profiled as the read stage
+        """
+        chunks = iter(self.df_terator)
+        while True:
+            with self.profiler.stage('read'):
+                df_chunk = next(chunks, None)
+            if df_chunk is None:
+                return
+            yield df_chunk
+
+    def run_preflight(self) -> dict:
+        """
+        Sends a canary sample of the first rows of the object before the full upload and checks the validation
+        reject rate and the meta acceptance rate against the preflight thresholds, suppressed rows are not rejects
+        The sample is split in probe_batches requests that are not bisected, so a systematic problem costs a
+        handful of requests. Raises PreflightFailed when the sample fails, token and permission errors fail at once
+        Sample rows are not sent again, the rest of the peeked chunk is chained in front of the df iterator
+        """
+        sample_size = self.get_config_value_or_default('preflight', 'sample_size', 50)
+        probe_batches = self.get_config_value_or_default('preflight', 'probe_batches', 5)
+        max_reject_rate = self.get_config_value_or_default('preflight', 'max_reject_rate', 0.1)
+        min_acceptance_rate = self.get_config_value_or_default('preflight', 'min_acceptance_rate', 0.9)
+        chunks = iter(self.df_terator)
+        with self.profiler.stage('read'):
+            first_chunk = next(chunks, None)
+        if first_chunk is None:
+            self.df_terator = chunks
+            return {"sample_rows": 0}
+        sample = first_chunk.iloc[:sample_size]
+        remainder = [first_chunk.iloc[sample_size:]] if len(first_chunk.index) > sample_size else []
+        self.df_terator = itertools.chain(remainder, chunks)
+
+        # only validation rejects count against the reject rate, opted-out customers are expected to be dropped
+        reject_counts = self.reject_counts.copy()
+        suppressed_rows = self.suppressed_rows
+        prepared = self.prepare_conversion_chunk(0, sample)
+        suppressed_rows = self.suppressed_rows - suppressed_rows
+        result = {"sample_rows": len(sample.index), "suppressed_rows": suppressed_rows,
+            "rejected_rows": len(sample.index) - len(prepared.index) - suppressed_rows,
+            "events_sent": 0, "events_received": 0, "errors": []}
+        result["reject_rate"] = round(result["rejected_rows"] / len(sample.index), 3)
+        if result["reject_rate"] > max_reject_rate:
+            raise PreflightFailed(f"reject rate {result['reject_rate']} of the sample is above {max_reject_rate}, "
+                f"reject reasons {dict(self.reject_counts - reject_counts)}")
+
+        pixel_id = self.get_config_value('conversions', 'pixel_id')
+        probe_size = max(1, -(-len(prepared.index) // probe_batches))
+        for start in range(0, len(prepared.index), probe_size):
+            events = self.build_events(0, prepared.iloc[start:start + probe_size])
+            result["events_sent"] += len(events)
+            try:
+                response = self.execute_event_request(self.get_event_request(events, pixel_id))
+            except FacebookRequestError as e:
+                if not self.is_bisectable_error(e):
+                    raise PreflightFailed(f"meta rejected the sample with error {e.api_error_code()}: "
+                        f"{e.api_error_message()}") from e
+                result["errors"].append(e.api_error_message())
+                self.reject_counts['rejected_by_meta'] += len(events)
+                self.write_rejects('preflight', None, '\n'.join(json.dumps(
+                    {"event": event.normalize(), "reject_reason": e.api_error_message()}, default=str)
+                    for event in events).encode(), len(events))
+                continue
+            result["events_received"] += response.get('events_received') or 0
+        if result["events_sent"]:
+            result["acceptance_rate"] = round(result["events_received"] / result["events_sent"], 3)
+            if result["acceptance_rate"] < min_acceptance_rate:
+                raise PreflightFailed(f"acceptance rate {result['acceptance_rate']} of the sample is below "
+                    f"{min_acceptance_rate}, errors {result['errors'][:3]}")
+        print(f"preflight passed {result}")
+        return result
+
+    def build_event_request(self, chunk_id: int, df_chunk: DataFrame) -> EventRequest:
+        """
+        Builds one event request with sample payload from a chunk of data
         """
         if (df_chunk.empty):
             print("***************")
             print("Empty dataframe detected. Exiting")
             print("***************")
             exit(2)
+        pixel_id = self.get_config_value('conversions', 'pixel_id')
+        # creates one chunk of events to be send in one request
+        print ("Adding chunk of data to one request")
+        return self.get_event_request(self.build_events(chunk_id, df_chunk), pixel_id)
+
+    def get_event_id(self, row_index) -> str:
+        """
+        Returns a deterministic event id of a row derived from the source object and the row index in it
+        Retried objects resend the same event ids, so meta deduplicates the events that were already delivered
+        """
+        return hashlib.sha256(f"{self.source_bucket}/{self.source_key}:{row_index}".encode('utf8')).hexdigest()[:32]
+
+    def build_events(self, chunk_id: int, df_chunk: DataFrame) -> list:
+        """
+        Builds fb sdk event objects for each row of a chunk of data
+        """
+        events = []
+        # print(df_chunk.head(2))
+        with self.profiler.stage('build'):
+            for row in df_chunk.itertuples():
+                user_data = self.get_user_data(row)
+                # print(user_data)
+                content = self.get_content()
+                custom_data = self.get_custom_data(content)
+                event_id = self.get_event_id(row.Index)
+                events.append(self.get_events_data(user_data, custom_data, event_id))
+        return events
+
+    def get_rate_limiter(self, key: str):
+        """
+        Returns the rate limiter all senders of a pixel id draw from, configured in the rate_limit config section
+        A DistributedTokenBucket is used when a dynamodb table is configured, a local TokenBucket otherwise
+        """
+        with rate_limiters_lock:
+            if key not in rate_limiters:
+                rate = self.get_config_value_or_default('rate_limit', 'events_per_second', 0.0)
+                table_name = self.get_config_value_or_default('rate_limit', 'table_name', rate_limit_table_name)
+                capacity = self.get_config_value_or_default('rate_limit', 'capacity', 0.0) or None
+                if table_name and rate > 0:
+                    rate_limiters[key] = DistributedTokenBucket(table_name, key, rate, capacity,
+                        block_size=self.get_config_value_or_default('rate_limit', 'block_size', 1000),
+                        endpoint_url=self.get_config_value_or_default('rate_limit', 'endpoint_url', ''))
+                else:
+                    rate_limiters[key] = TokenBucket(rate, capacity)
+            return rate_limiters[key]
+
+    def execute_event_request(self, event_request: EventRequest) -> dict:
+        """
+        Sends a built event request to meta facebook marketing conversions api
+        """
         # gets connection configuration
         access_token = self.get_config_value('conversions', 'access_token')
-        pixel_id = self.get_config_value('conversions', 'pixel_id')
         
         # intiates connection
         FacebookAdsApi.init(access_token=access_token)
+        self.get_rate_limiter(event_request.pixel_id).acquire(len(event_request.events))
 
-        events = []
-        # print(df_chunk.head(2))
-        # creates one chunk of events to be send in one request
-        print ("Adding chunk of data to one request")
-        for row in df_chunk.itertuples():
-            user_data = self.get_user_data(row)
-            # print(user_data)
-            content = self.get_content()
-            custom_data = self.get_custom_data(content)
-            #generate dummy event id
-            event_id = time.monotonic_ns() + chunk_id
-            events.append(self.get_events_data(user_data, custom_data, event_id))
-        
-        event_request = self.get_event_request(events, pixel_id)
         print ("Sending chunk of data to Meta Conversions API")
-        event_response = event_request.execute()
+        with self.profiler.stage('send'):
+            event_response = event_request.execute()
         response_dict = event_response.to_dict()
         print(json.dumps(response_dict, indent=4))
         return response_dict
 
+    def send_event_request(self, event_request: EventRequest, chunk_id: int=None) -> dict:
+        """
+        Sends a built event request, when meta rejects it because of invalid events the request is bisected
+        so that all valid events are still delivered
+        """
+        if not self.get_config_value_or_default('bisection', 'enabled', True):
+            return self.execute_event_request(event_request)
+        return self.send_with_bisection(
+            event_request.events,
+            lambda events: self.execute_event_request(self.get_event_request(events, event_request.pixel_id)),
+            lambda event: event.normalize(),
+            chunk_id,
+        )
+
+    @staticmethod
+    def is_bisectable_error(error: Exception) -> bool:
+        """
+        Returns True when meta rejected a request because of its content, so a subset of it may still be accepted
+        """
+        return (isinstance(error, FacebookRequestError) and error.http_status() == 400
+            and error.api_error_code() not in non_bisectable_error_codes)
+
+    def send_with_bisection(self, items: list, send_items, to_record, chunk_id: int=None,
+        rejected_error: Exception=None) -> dict:
+        """
+        Sends items in one request, a rejected request is split in halves that are resent level by level until the
+        offending items are isolated. Single rejected items go to the reject sink with the error message
+        With k bad items in n, about 2k*log2(n) requests are sent instead of one request per item. Requests are
+        capped by the bisection max_requests config, parts not sent when the cap is reached are written to the
+        reject sink whole, so a batch of only bad events costs max_requests instead of 2n-1 requests
+        :param items: events of the request
+        :param send_items: sends a list of items and returns the response dict
+        :param to_record: returns the json serializable reject record of an item
+        :param rejected_error: error of a request of all items the caller already sent, it is not sent again
+        """
+        max_requests = self.get_config_value_or_default('bisection', 'max_requests', 64)
+        merged = {"events_received": 0, "messages": [], "fbtrace_id": None, "requests": 0, "rejected_events": 0}
+        rejects = []
+        unsent = 0
+        if rejected_error is not None:
+            merged["requests"] = 1
+        # breadth first, so the cap leaves the smallest parts unsent
+        parts = deque([(items, rejected_error)])
+        while parts:
+            part, error = parts.popleft()
+            if error is None:
+                if merged["requests"] >= max_requests:
+                    rejects.extend({"event": to_record(item), "reject_reason":
+                        f"not sent, bisection stopped after {max_requests} requests"} for item in part)
+                    unsent += len(part)
+                    continue
+                merged["requests"] += 1
+                try:
+                    response = send_items(part)
+                except Exception as e:
+                    if not self.is_bisectable_error(e):
+                        raise
+                    error = e
+                else:
+                    merged["events_received"] += response.get('events_received') or 0
+                    merged["messages"].extend(response.get('messages') or [])
+                    merged["fbtrace_id"] = merged["fbtrace_id"] or response.get('fbtrace_id')
+                    continue
+            if len(part) == 1:
+                rejects.append({"event": to_record(part[0]), "reject_reason": error.api_error_message()})
+                continue
+            middle = len(part) // 2
+            parts.append((part[:middle], None))
+            parts.append((part[middle:], None))
+
+        if rejects:
+            merged["rejected_events"] = len(rejects)
+            self.reject_counts['rejected_by_meta'] += len(rejects) - unsent
+            if unsent:
+                self.reject_counts['bisection_capped'] += unsent
+            body = '\n'.join(json.dumps(record, default=str) for record in rejects).encode()
+            self.write_rejects('bisection', chunk_id, body, len(rejects))
+        return merged
+
+    @staticmethod
+    def encode_events(events: list) -> bytes:
+        """
+        Encodes fb sdk event objects in to the json data parameter of an events request
+        """
+        return json.dumps([event.normalize() for event in events]).encode('utf8')
+
+    def execute_encoded_request(self, pixel_id: str, data: bytes, events_count: int) -> dict:
+        """
+        Sends json encoded events to meta facebook marketing conversions api without building sdk objects
+        """
+        access_token = self.get_config_value('conversions', 'access_token')
+        api = FacebookAdsApi.init(access_token=access_token)
+        self.get_rate_limiter(pixel_id).acquire(events_count)
+        params = {'data': data.decode('utf8'), 'test_event_code': test_event_code}
+        print ("Sending encoded chunk of data to Meta Conversions API")
+        with self.profiler.stage('send'):
+            response = api.call('POST', (pixel_id, 'events'), params=params)
+        return response.json()
+
+    def send_encoded_events(self, pixel_id: str, data: bytes, events_count: int, chunk_id: int=None) -> dict:
+        """
+        Sends json encoded events, the data is only decoded when meta rejects it and the request is bisected
+        """
+        try:
+            return self.execute_encoded_request(pixel_id, data, events_count)
+        except Exception as e:
+            if not (self.get_config_value_or_default('bisection', 'enabled', True) and self.is_bisectable_error(e)):
+                raise
+            rejected_error = e
+        return self.send_with_bisection(
+            json.loads(data),
+            lambda items: self.execute_encoded_request(pixel_id, json.dumps(items).encode('utf8'), len(items)),
+            lambda item: item,
+            chunk_id,
+            rejected_error=rejected_error,
+        )
+
+    def is_ndjson_source(self) -> bool:
+        """
+        Returns True when the source object holds pre-encoded event payload lines instead of csv rows
+        """
+        return self.source_key.endswith(ndjson_suffixes)
+
+    def iterate_conversion_data_byte_pump(self, max_events: int=1000, max_body_bytes: int=2097152,
+        sender_workers: int=4, in_memory: bool=False) -> dict:
+        """
+        Streams pre-encoded event payload lines of the source object and concatenates them in to request bodies
+        of up to max_events events and max_body_bytes bytes. No DataFrame or sdk objects are built,
+        rows are expected to be normalized and hashed by the glue job
+        """
+        pixel_id = self.get_config_value('conversions', 'pixel_id')
+        stream = self.open_source_stream(self.get_source_compression(), in_memory)
+        # an uncompressed s3 body iterates in fixed size chunks, decompressed and in memory streams iterate lines
+        line_iterator = stream.iter_lines() if hasattr(stream, 'iter_lines') else stream
+        responses = {}
+        with ThreadPoolExecutor(max_workers=sender_workers, thread_name_prefix="meta-sender") as executor:
+            futures = {}
+
+            def flush(chunk_id, lines):
+                futures[chunk_id] = executor.submit(self.send_encoded_events, pixel_id, b'[' + b','.join(lines) + b']',
+                    len(lines), chunk_id)
+                # keeps the number of bodies waiting for a sender bounded
+                while len(futures) >= sender_workers * 2:
+                    oldest = min(futures)
+                    responses[oldest] = futures.pop(oldest).result()
+
+            chunk_id = 0
+            lines = []
+            body_bytes = 2
+            with self.profiler.stage('read'):
+                for line in line_iterator:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    if lines and (len(lines) >= max_events or body_bytes + len(line) + 1 > max_body_bytes):
+                        flush(chunk_id, lines)
+                        chunk_id += 1
+                        lines = []
+                        body_bytes = 2
+                    lines.append(line)
+                    body_bytes += len(line) + 1
+                if lines:
+                    flush(chunk_id, lines)
+            for pending_chunk_id in list(futures):
+                responses[pending_chunk_id] = futures.pop(pending_chunk_id).result()
+        return {"responses": [responses[chunk_id] for chunk_id in sorted(responses)]}
+
+    def encode_worker(self, connection) -> None:
+        """
+        Runs in a forked process, builds and encodes the chunks received on the pipe until None is received
+        Encoded bodies are sent back as raw bytes prefixed with the chunk id, so they are not pickled again
+        """
+        while True:
+            message = connection.recv()
+            if message is None:
+                break
+            chunk_id, df_chunk = message
+            data = self.encode_events(self.build_events(chunk_id, df_chunk))
+            connection.send_bytes(chunk_id.to_bytes(8, 'little') + data)
+        connection.close()
+
+    def iterate_conversion_data_process_pool(self, workers: int=None, sender_workers: int=4) -> dict:
+        """
+        iterate through chunks of df iterator object, building and encoding request bodies in parallel in forked
+        worker processes while the main process reads, validates and sends
+        Workers are connected with pipes only, multiprocessing pools and queues need /dev/shm semaphores
+        that are not available in lambda. Each worker has at most one chunk outstanding, so it is always waiting
+        in recv when a chunk is sent to it and neither side can block on a full pipe while the other one writes
+        """
+        workers = workers or os.cpu_count() or 1
+        pixel_id = self.get_config_value('conversions', 'pixel_id')
+        context = multiprocessing.get_context('fork')
+        connections = {}
+        processes = []
+        for _ in range(workers):
+            parent_connection, child_connection = context.Pipe()
+            process = context.Process(target=self.encode_worker, args=(child_connection,), daemon=True)
+            process.start()
+            child_connection.close()
+            connections[parent_connection] = 0
+            processes.append(process)
+
+        responses = {}
+        chunk_sizes = {}
+        with ThreadPoolExecutor(max_workers=sender_workers, thread_name_prefix="meta-sender") as executor:
+            futures = {}
+
+            def collect(block: bool) -> None:
+                # hands encoded bodies of finished chunks to the sender pool
+                busy = [connection for connection, outstanding in connections.items() if outstanding]
+                for connection in wait_connections(busy, timeout=None if block else 0):
+                    result = connection.recv_bytes()
+                    connections[connection] -= 1
+                    chunk_id = int.from_bytes(result[:8], 'little')
+                    futures[chunk_id] = executor.submit(self.send_encoded_events, pixel_id, result[8:],
+                        chunk_sizes.pop(chunk_id), chunk_id)
+                for chunk_id in [chunk_id for chunk_id, future in futures.items() if future.done()]:
+                    responses[chunk_id] = futures.pop(chunk_id).result()
+
+            try:
+                for i, df_chunk in enumerate(self.iterate_df_chunks()):
+                    print(f"processing chunk {i}")
+                    needed_cols_df_chunk = self.prepare_conversion_chunk(i, df_chunk)
+                    if needed_cols_df_chunk.empty:
+                        continue
+                    while min(connections.values()) >= 1 or len(futures) >= sender_workers * 2:
+                        collect(block=min(connections.values()) >= 1)
+                        if len(futures) >= sender_workers * 2:
+                            next(iter(futures.values())).result()
+                    connection = min(connections, key=connections.get)
+                    connection.send((i, needed_cols_df_chunk))
+                    chunk_sizes[i] = len(needed_cols_df_chunk.index)
+                    connections[connection] += 1
+                    collect(block=False)
+                while any(connections.values()):
+                    collect(block=True)
+                for chunk_id in list(futures):
+                    responses[chunk_id] = futures.pop(chunk_id).result()
+            finally:
+                for connection in connections:
+                    try:
+                        connection.send(None)
+                    except OSError:
+                        pass
+                for process in processes:
+                    process.join(timeout=5)
+                    if process.is_alive():
+                        process.terminate()
+                for connection in connections:
+                    connection.close()
+        return {"responses": [responses[chunk_id] for chunk_id in sorted(responses)]}
+
+    def send_conversion_data(self, chunk_id: int, df_chunk: DataFrame):
+        """
+        Sends sample payload to meta facebook marketing conversions api
+        """
+        return self.send_event_request(self.build_event_request(chunk_id, df_chunk), chunk_id)
+
     def iterate_conversion_data_chunks(self) -> dict:
         """
         iterate through chunks of df iterator object, extracts required cols to be sent
         """
         event_response_dict = {"responses":[]}
-        for i, df_chunk in enumerate(self.df_terator):
+        for i, df_chunk in enumerate(self.iterate_df_chunks()):
             # optional if input file has more columns than that is needed in the request to api
             print(f"processing chunk {i}")
-            needed_cols_df_chunk = self.get_needed_cols_df_chunk(df_chunk)
+            needed_cols_df_chunk = self.prepare_conversion_chunk(i, df_chunk)
+            if needed_cols_df_chunk.empty:
+                continue
             event_response_dict['responses'].append(self.send_conversion_data(i,needed_cols_df_chunk))
         return event_response_dict
 
+    def iterate_conversion_data_pipelined(self, read_queue_depth: int=2, encode_queue_depth: int=4,
+        sender_workers: int=4) -> dict:
+        """
+        iterate through chunks of df iterator object using pipelined stages connected by bounded queues
+        reader thread -> normalizer/encoder (calling thread) -> sender thread pool
+        Building the next request overlaps the network I/O of the ones being sent. A full queue blocks the
+        stage in front of it, so at most read_queue_depth + encode_queue_depth + sender_workers chunks are in memory
+        """
+        read_queue = queue.Queue(maxsize=read_queue_depth)
+        send_queue = queue.Queue(maxsize=encode_queue_depth)
+        stop = threading.Event()
+        errors = []
+        responses = {}
+
+        def put(target_queue, item):
+            # blocks while the queue is full unless another stage failed
+            while not stop.is_set():
+                try:
+                    target_queue.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def get(source_queue):
+            while not stop.is_set():
+                try:
+                    return source_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            return None
+
+        def reader():
+            try:
+                for i, df_chunk in enumerate(self.iterate_df_chunks()):
+                    print(f"processing chunk {i}")
+                    needed_cols_df_chunk = self.prepare_conversion_chunk(i, df_chunk)
+                    if needed_cols_df_chunk.empty:
+                        continue
+                    put(read_queue, (i, needed_cols_df_chunk))
+                    if stop.is_set():
+                        break
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                put(read_queue, None)
+
+        def sender():
+            try:
+                while True:
+                    item = get(send_queue)
+                    if item is None:
+                        return
+                    chunk_id, event_request = item
+                    responses[chunk_id] = self.send_event_request(event_request, chunk_id)
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+
+        reader_thread = threading.Thread(target=reader, name="meta-reader", daemon=True)
+        reader_thread.start()
+        with ThreadPoolExecutor(max_workers=sender_workers, thread_name_prefix="meta-sender") as executor:
+            sender_futures = [executor.submit(sender) for _ in range(sender_workers)]
+            try:
+                while True:
+                    item = get(read_queue)
+                    if item is None:
+                        break
+                    chunk_id, df_chunk = item
+                    put(send_queue, (chunk_id, self.build_event_request(chunk_id, df_chunk)))
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                # one end marker per sender
+                for _ in sender_futures:
+                    put(send_queue, None)
+        reader_thread.join()
+
+        if errors:
+            raise errors[0]
+        return {"responses": [responses[chunk_id] for chunk_id in sorted(responses)]}
+
+    def iterate_conversion_data_coalesced(self, object_events: list, max_events: int=1000) -> dict:
+        """
+        Packs rows of several small s3 objects in to full size event requests instead of one partial request per object
+        :param object_events: (source id, EventBridge event) pairs, the source id is used to map responses back
+        :param max_events: events per request
+        Returns the accounting per source id and the source ids that failed. A failed request fails every source
+        with events in it, so those sources are retried as a whole. Event ids are derived from the source object
+        and row index, so meta deduplicates the events of retried sources that earlier requests already delivered
+        """
+        pixel_id = self.get_config_value('conversions', 'pixel_id')
+        sources = {source_id: {"events_sent": 0, "fbtrace_ids": []} for source_id, object_event in object_events}
+        failed_sources = set()
+        pending = []
+
+        def flush(batch):
+            batch_sources = Counter(source_id for source_id, event in batch)
+            try:
+                response = self.send_event_request(self.get_event_request([event for source_id, event in batch], pixel_id))
+            except Exception:
+                print(f"Failed sending coalesced request of sources {list(batch_sources)}")
+                traceback.print_exc()
+                failed_sources.update(batch_sources)
+                return
+            for source_id, count in batch_sources.items():
+                sources[source_id]["events_sent"] += count
+                sources[source_id]["fbtrace_ids"].append(response.get('fbtrace_id'))
+
+        for source_id, object_event in object_events:
+            try:
+                self.set_s3_source_file_uri(object_event)
+                self.set_df_iterator(chunksize=max_events, in_memory=True)
+                for i, df_chunk in enumerate(self.iterate_df_chunks()):
+                    needed_cols_df_chunk = self.prepare_conversion_chunk(i, df_chunk)
+                    if needed_cols_df_chunk.empty:
+                        continue
+                    pending.extend((source_id, event) for event in self.build_events(i, needed_cols_df_chunk))
+                    while len(pending) >= max_events:
+                        flush(pending[:max_events])
+                        pending = pending[max_events:]
+            except Exception:
+                print(f"Failed reading source {source_id}")
+                traceback.print_exc()
+                failed_sources.add(source_id)
+                pending = [item for item in pending if item[0] != source_id]
+        if pending:
+            flush(pending)
+        emit_metrics({"Source": "coalesced"}, {
+            "CoalescedObjects": (len(object_events), "Count"),
+            "CoalescedEvents": (sum(source["events_sent"] for source in sources.values()), "Count"),
+            "SuppressedRows": (self.suppressed_rows, "Count")
+        })
+        return {"sources": sources, "failed_sources": sorted(failed_sources)}
+
+    def get_destinations(self) -> dict:
+        """
+        Returns PixelDestination objects keyed by the routing column value
+        Mapping of routing column values to pixel ids is read from the destination_pixel_ids config section
+        """
+        batch_size = self.get_config_value_or_default('destinations', 'batch_size', 1000)
+        rate = self.get_config_value_or_default('destinations', 'events_per_second', 0.0)
+        # values mapped to the same pixel id share one buffer and rate limit
+        pixel_destinations = {}
+        destinations = {}
+        mapping = self.config.items('destination_pixel_ids') if self.config.has_section('destination_pixel_ids') else []
+        default_pixel_id = self.get_config_value_or_default('destinations', 'default_pixel_id', '')
+        if default_pixel_id:
+            mapping = list(mapping) + [(None, default_pixel_id)]
+        for value, pixel_id in mapping:
+            if pixel_id not in pixel_destinations:
+                pixel_destinations[pixel_id] = PixelDestination(pixel_id, batch_size, TokenBucket(rate))
+            destinations[value] = pixel_destinations[pixel_id]
+        return destinations
+
+    def flush_destination_batch(self, destination: PixelDestination, events: list) -> None:
+        """
+        Sends one batch of a destination after taking its rate limit tokens
+        """
+        throttled_seconds = destination.rate_limiter.acquire(len(events))
+        response = self.send_event_request(self.get_event_request(events, destination.pixel_id))
+        destination.record_response(response.get('events_received', len(events)), throttled_seconds, response)
+
+    def iterate_conversion_data_multi_destination(self) -> dict:
+        """
+        iterate once through chunks of df iterator object and routes each row to a pixel id based on the
+        value of the destinations routing_column. Each destination has its own batch buffer and rate limit,
+        full batches of all destinations are flushed concurrently
+        Routing column values are matched in lower case as config keys are case insensitive
+        Rows without a mapped pixel id go to default_pixel_id when configured, otherwise they are counted and skipped
+        """
+        routing_column = self.get_config_value('destinations', 'routing_column')
+        max_workers = self.get_config_value_or_default('destinations', 'max_workers', 4)
+        destinations = self.get_destinations()
+        unique_destinations = list({id(destination): destination for destination in destinations.values()}.values())
+        unrouted_rows = 0
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="meta-destination") as executor:
+            futures = []
+            for i, df_chunk in enumerate(self.iterate_df_chunks()):
+                print(f"processing chunk {i}")
+                needed_cols_df_chunk = self.prepare_conversion_chunk(i, df_chunk)
+                routing_values = df_chunk.loc[needed_cols_df_chunk.index, routing_column].astype(str).str.strip().str.lower()
+                for value, df_group in needed_cols_df_chunk.groupby(routing_values, sort=False):
+                    destination = destinations.get(value, destinations.get(None))
+                    if destination is None:
+                        unrouted_rows += len(df_group.index)
+                        continue
+                    for batch in destination.add_events(self.build_events(i, df_group)):
+                        futures.append(executor.submit(self.flush_destination_batch, destination, batch))
+                # keeps the number of batches waiting for a sender bounded
+                while len(futures) >= max_workers * 2:
+                    futures.pop(0).result()
+            for destination in unique_destinations:
+                for batch in destination.drain():
+                    futures.append(executor.submit(self.flush_destination_batch, destination, batch))
+            for future in futures:
+                future.result()
+
+        for destination in unique_destinations:
+            emit_metrics({"PixelId": destination.pixel_id}, {
+                "DestinationEventsSent": (destination.events_sent, "Count"),
+                "DestinationThrottledTime": (int(destination.throttled_seconds * 1000), "Milliseconds")
+            })
+        return {
+            "responses": [],
+            "destinations": {destination.pixel_id: destination.get_summary() for destination in unique_destinations},
+            "unrouted_rows": unrouted_rows,
+        }
+
+    def get_sinks(self) -> list:
+        """
+        Returns the sinks listed in the enabled key of the sinks config section
+        The type of a sink defaults to its name, so sinks named after a registered type need no own section
+        """
+        sinks = []
+        for name in self.get_config_value('sinks', 'enabled').split(','):
+            name = name.strip()
+            if not name:
+                continue
+            sink_type = self.get_config_value_or_default(f"sink_{name}", 'type', name)
+            if sink_type not in sink_types:
+                raise ValueError(f"Unsupported sink type {sink_type} of sink {name}")
+            sinks.append(sink_types[sink_type](name, self))
+        return sinks
+
+    def iterate_conversion_data_sinks(self) -> dict:
+        """
+        iterate once through chunks of df iterator object and feeds each prepared chunk to all configured sinks
+        Sinks batch and send concurrently with each other and with reading the next chunk
+        """
+        sinks = self.get_sinks()
+        try:
+            for i, df_chunk in enumerate(self.iterate_df_chunks()):
+                print(f"processing chunk {i}")
+                needed_cols_df_chunk = self.prepare_conversion_chunk(i, df_chunk)
+                if needed_cols_df_chunk.empty:
+                    continue
+                for sink in sinks:
+                    sink.add_chunk(needed_cols_df_chunk)
+            summaries = {sink.name: sink.close() for sink in sinks}
+        finally:
+            for sink in sinks:
+                sink.executor.shutdown(wait=False, cancel_futures=True)
+
+        for name, summary in summaries.items():
+            emit_metrics({"Sink": name}, {
+                "SinkRowsSent": (summary['rows_sent'], "Count"),
+                "SinkFailedRows": (summary['failed_rows'], "Count")
+            })
+        return {"responses": [], "sinks": summaries}
+
 def load_config(ssm_parameter_path):
     """
     Load configparser from config stored in SSM Parameter Store
@@ -318,6 +1772,59 @@ def load_config(ssm_parameter_path):
     finally:
         return configuration
 
+def emit_metrics(dimensions: dict, metrics: dict) -> None:
+    """
+    Prints metrics in CloudWatch embedded metric format, lambda log ingestion turns these lines in to metrics
+    :param dimensions: dimension name and value pairs
+    :param metrics: metric name and (value, unit) pairs
+    """
+    payload = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": metrics_namespace,
+                "Dimensions": [list(dimensions.keys())],
+                "Metrics": [{"Name": name, "Unit": unit} for name, (value, unit) in metrics.items()]
+            }]
+        }
+    }
+    payload.update(dimensions)
+    payload.update({name: value for name, (value, unit) in metrics.items()})
+    print(json.dumps(payload))
+
+def get_profiler(connector: MetaAWSAMTConnector, context) -> InvocationProfiler:
+    """
+    Returns the profiler of an invocation from the optional profiling config section
+    A sample_rate below 1 profiles only that fraction of the invocations
+    """
+    s3_prefix = connector.get_config_value_or_default('profiling', 's3_prefix', '')
+    enabled = connector.get_config_value_or_default('profiling', 'enabled', False) and s3_prefix != ''
+    # random is only used for sampling invocations, not for security
+    sampled = random.random() < connector.get_config_value_or_default('profiling', 'sample_rate', 1.0)  # nosec B311
+    invocation_id = getattr(context, 'aws_request_id', None) or str(time.time_ns())
+    return InvocationProfiler(
+        invocation_id=invocation_id,
+        enabled=enabled and sampled,
+        mode=connector.get_config_value_or_default('profiling', 'mode', 'cprofile'),
+        memory=connector.get_config_value_or_default('profiling', 'memory', False),
+        s3_prefix=s3_prefix,
+        sampling_interval=connector.get_config_value_or_default('profiling', 'sampling_interval_ms', 10) / 1000,
+    )
+
+def get_object_route(event) -> str:
+    """
+    Returns the processing route of the s3 object in the EventBridge event based on the object size
+    small objects use the in-lambda fast path, medium the standard connector and large the pipelined path
+    """
+    size = event['detail']['object'].get('size')
+    if size is None:
+        return 'medium'
+    if size <= small_object_max_bytes:
+        return 'small'
+    if size >= large_object_min_bytes:
+        return 'large'
+    return 'medium'
+
 def get_sample_event():
     """
     returns sample payload for testing purposes
@@ -353,22 +1860,270 @@ def get_sample_event():
     }
     return payload
 
-def lambda_handler(event, context):
-
-    print("Loading config and creating new MyApp...")
-    config = load_config(full_config_path)
+def process_object_event(event, context, config) -> dict:
+    """
+    Sends the s3 object of one EventBridge Object Created event to meta
+    """
     app = MetaAWSAMTConnector(config)
     print("getting event and identifying object name that got uploaded")
     app.set_s3_source_file_uri(event)
-    print("read s3 object data and set the chunk iterator object")
-    # use below for limited testing
-    # app.set_df_iterator(limit_rows=50, chunksize=5, delimeter=',', encoding='iso8859-1')
-    # use below for production
-    app.set_df_iterator(chunksize=1000)
-    print("Itrate each chunks")
-    response = app.iterate_conversion_data_chunks()
+    route = get_object_route(event)
+    print(f"routing object through the {route} path")
+    emit_metrics({"Route": route}, {
+        "RoutedObjects": (1, "Count"),
+        "RoutedObjectSize": (event['detail']['object'].get('size', 0), "Bytes")
+    })
+    start_time = time.monotonic()
+    app.profiler = get_profiler(app, context)
+    preflight = None
+    try:
+        if app.is_ndjson_source():
+            print("sending pre-encoded event lines in byte pump mode")
+            response = app.iterate_conversion_data_byte_pump(
+                max_events=app.get_config_value_or_default('byte_pump', 'max_events', 1000),
+                max_body_bytes=app.get_config_value_or_default('byte_pump', 'max_body_bytes', 2097152),
+                sender_workers=app.get_config_value_or_default('byte_pump', 'sender_workers', 4),
+                in_memory=(route == 'small'))
+        else:
+            print("read s3 object data and set the chunk iterator object")
+            # use below for limited testing
+            # app.set_df_iterator(limit_rows=50, chunksize=5, delimeter=',', encoding='iso8859-1')
+            # use below for production
+            with app.profiler.stage('read'):
+                app.set_df_iterator(chunksize=1000, in_memory=(route == 'small'))
+            # the canary sample goes to the conversions pixel id, so routed and sink uploads are not preflighted
+            if (app.get_config_value_or_default('preflight', 'enabled', False)
+                and not app.get_config_value_or_default('destinations', 'routing_column', '')
+                and not app.get_config_value_or_default('sinks', 'enabled', '')):
+                try:
+                    preflight = app.run_preflight()
+                except PreflightFailed:
+                    emit_metrics({"Route": route}, {"PreflightFailures": (1, "Count")})
+                    raise
+            print("Itrate each chunks")
+            if app.get_config_value_or_default('destinations', 'routing_column', ''):
+                response = app.iterate_conversion_data_multi_destination()
+            elif app.get_config_value_or_default('sinks', 'enabled', ''):
+                response = app.iterate_conversion_data_sinks()
+            elif route != 'small' and app.get_config_value_or_default('process_pool', 'enabled', False):
+                response = app.iterate_conversion_data_process_pool(
+                    workers=app.get_config_value_or_default('process_pool', 'workers', 0),
+                    sender_workers=app.get_config_value_or_default('process_pool', 'sender_workers', 4))
+            elif route == 'large':
+                pipeline_settings = app.get_pipeline_settings()
+                pipeline_settings['sender_workers'] = large_object_workers
+                response = app.iterate_conversion_data_pipelined(**pipeline_settings)
+            elif route == 'medium' and app.get_config_value_or_default('pipeline', 'enabled', False):
+                response = app.iterate_conversion_data_pipelined(**app.get_pipeline_settings())
+            else:
+                response = app.iterate_conversion_data_chunks()
+    finally:
+        # profiling must not fail an upload, the sqs path would send the whole object again
+        try:
+            app.profiler.write_artifacts()
+        except Exception:
+            print("Failed writing profiling artifacts")
+            traceback.print_exc()
+    if preflight is not None:
+        response['preflight'] = preflight
+    for reason, count in app.reject_counts.items():
+        emit_metrics({"RejectReason": reason}, {"RejectedRows": (count, "Count")})
+    if app.suppression_index is not None:
+        emit_metrics({"Route": route}, {"SuppressedRows": (app.suppressed_rows, "Count")})
+    emit_metrics({"Route": route}, {
+        "RouteDuration": (int((time.monotonic() - start_time) * 1000), "Milliseconds"),
+        "RouteRequests": (len(response['responses']) + sum(
+            summary['requests'] for summary in [*response.get('destinations', {}).values(),
+                *response.get('sinks', {}).values()]), "Count")
+    })
     return response
 
+def get_record_route(record) -> str:
+    """
+    Returns the route of the object event in an SQS record body, None when the body is not an object event
+    """
+    try:
+        return get_object_route(json.loads(record['body']))
+    except Exception:
+        return None
+
+def requeue_records(records: list) -> list:
+    """
+    Sends unstarted SQS records to their queue again as new messages and returns the records that could not be sent
+    Requeued messages start with a new receive count, so records deferred by busy invocations do not end in the DLQ
+    """
+    failed = list(records)
+    try:
+        for queue_arn in {record['eventSourceARN'] for record in records}:
+            account, queue_name = queue_arn.split(':')[4:6]
+            queue_url = sqs_client.get_queue_url(QueueName=queue_name, QueueOwnerAWSAccountId=account)['QueueUrl']
+            queue_records = [record for record in records if record['eventSourceARN'] == queue_arn]
+            for start in range(0, len(queue_records), 10):
+                batch = queue_records[start:start + 10]
+                response = sqs_client.send_message_batch(QueueUrl=queue_url, Entries=[
+                    {"Id": str(index), "MessageBody": record['body']} for index, record in enumerate(batch)])
+                for entry in response.get('Successful', []):
+                    failed.remove(batch[int(entry['Id'])])
+    except Exception:
+        print("Failed requeueing unstarted records")
+        traceback.print_exc()
+    return failed
+
+def lambda_handler(event, context):
+    """
+    Handles an EventBridge Object Created event or a batch of them buffered in SQS
+    For SQS batches failed records are reported as batch item failures, so only those are retried
+    Records of a batch share one invocation, large objects are started first and a record is only started while
+    the ingestion min_remaining_ms (large_object_min_remaining_ms for large objects) of the invocation is left.
+    Unstarted records are sent to the queue again, so finished records are not redelivered when time runs out
+    """
+    print("Loading config and creating new MyApp...")
+    config = load_config(full_config_path)
+    if 'Records' not in event:
+        return process_object_event(event, context, config)
+
+    print(f"processing batch of {len(event['Records'])} records")
+    responses = {}
+    batch_item_failures = []
+    small_object_events = []
+    unstarted_records = []
+    connector = MetaAWSAMTConnector(config)
+    coalescing_enabled = connector.get_config_value_or_default('coalescing', 'enabled', False)
+    min_remaining_ms = {
+        'large': connector.get_config_value_or_default('ingestion', 'large_object_min_remaining_ms', 600000),
+        None: connector.get_config_value_or_default('ingestion', 'min_remaining_ms', 60000),
+    }
+
+    def has_time_for(route: str) -> bool:
+        if context is None:
+            return True
+        return context.get_remaining_time_in_millis() >= min_remaining_ms.get(route, min_remaining_ms[None])
+
+    # a large object started first gets the whole invocation, like it did before batching
+    for record in sorted(event['Records'], key=lambda record: get_record_route(record) != 'large'):
+        try:
+            object_event = json.loads(record['body'])
+            route = get_object_route(object_event)
+            # small objects of the batch are packed together in to full size requests
+            if (coalescing_enabled and route == 'small'
+                and not object_event['detail']['object']['key'].endswith(ndjson_suffixes)):
+                small_object_events.append((record, object_event))
+                continue
+            if not has_time_for(route):
+                unstarted_records.append(record)
+                continue
+            responses[record['messageId']] = process_object_event(object_event, context, config)
+        except Exception:
+            print(f"Failed processing record {record['messageId']}")
+            traceback.print_exc()
+            batch_item_failures.append({"itemIdentifier": record['messageId']})
+    if small_object_events and not has_time_for('small'):
+        unstarted_records.extend(record for record, object_event in small_object_events)
+    elif small_object_events:
+        app = MetaAWSAMTConnector(config)
+        max_events = app.get_config_value_or_default('coalescing', 'max_events', 1000)
+        coalesced_response = app.iterate_conversion_data_coalesced(
+            [(record['messageId'], object_event) for record, object_event in small_object_events], max_events)
+        responses.update(coalesced_response['sources'])
+        batch_item_failures.extend({"itemIdentifier": message_id} for message_id in coalesced_response['failed_sources'])
+    requeued = 0
+    if unstarted_records:
+        print(f"{len(unstarted_records)} records not started, the invocation is running out of time")
+        not_requeued = requeue_records(unstarted_records)
+        requeued = len(unstarted_records) - len(not_requeued)
+        # records that could not be requeued are retried by sqs after the visibility timeout
+        batch_item_failures.extend({"itemIdentifier": record['messageId']} for record in not_requeued)
+    emit_metrics({"Source": "sqs"}, {
+        "BatchRecords": (len(event['Records']), "Count"),
+        "BatchRecordFailures": (len(batch_item_failures), "Count"),
+        "BatchRecordsRequeued": (requeued, "Count")
+    })
+    return {"batchItemFailures": batch_item_failures, "responses": responses}
+
+def get_stream_record(record) -> tuple:
+    """
+    Returns the item identifier, arrival time in epoch seconds and json body of a Kinesis or SQS record
+    """
+    if 'kinesis' in record:
+        return (record['kinesis']['sequenceNumber'], float(record['kinesis']['approximateArrivalTimestamp']),
+            base64.b64decode(record['kinesis']['data']))
+    return record['messageId'], int(record['attributes']['SentTimestamp']) / 1000, record['body']
+
+def stream_handler(event, context):
+    """
+    Handles a batch of Kinesis or SQS records, each holding one json row or a list of rows keyed by the glue job
+    output columns, and sends them to meta in micro-batches within seconds of their arrival
+    A micro-batch is flushed when it holds streaming max_events rows or max_latency_ms passed since its first row
+    was buffered by the handler, the event source batch window bounds the wait before the invocation. Records of
+    failed micro-batches are reported as batch item failures, records that are not valid json are written to rejects
+    Reports p50/p99 of the end to end latency from record arrival to meta response
+    """
+    config = load_config(full_config_path)
+    app = MetaAWSAMTConnector(config)
+    app.source_key = 'stream'
+    max_events = app.get_config_value_or_default('streaming', 'max_events', 1000)
+    max_latency = app.get_config_value_or_default('streaming', 'max_latency_ms', 1000) / 1000
+    latencies = []
+    responses = []
+    batch_item_failures = []
+    batch = {"ids": [], "arrivals": [], "rows": [], "keys": []}
+    # the deadline is measured from buffering, arrival times are only used for the latency metrics because
+    # records already waited up to the batch window of the event source before the invocation
+    batch_started = 0.0
+
+    def flush():
+        if not batch['rows']:
+            return
+        batch_id = len(responses) + len(batch_item_failures)
+        try:
+            df_batch = app.prepare_conversion_chunk(batch_id, app.rows_to_df(batch['rows'], batch['keys']))
+            if not df_batch.empty:
+                responses.append(app.send_conversion_data(batch_id, df_batch))
+            completed = time.time()
+            latencies.extend(completed - arrival for arrival in batch['arrivals'])
+        except Exception:
+            print(f"Failed sending micro-batch {batch_id}")
+            traceback.print_exc()
+            batch_item_failures.extend({"itemIdentifier": item_id} for item_id in dict.fromkeys(batch['ids']))
+        for values in batch.values():
+            values.clear()
+
+    for record in event.get('Records', []):
+        item_id, arrival, body = get_stream_record(record)
+        try:
+            rows = json.loads(body)
+        except ValueError:
+            app.write_rejects('stream', None, json.dumps({"record": item_id, "reject_reason": "invalid_json"}).encode(), 1)
+            continue
+        if not batch['rows']:
+            batch_started = time.monotonic()
+        for position, row in enumerate(rows if isinstance(rows, list) else [rows]):
+            # redelivered records keep their id, so their rows get the same event ids
+            batch['keys'].append(f"{item_id}:{position}")
+            batch['ids'].append(item_id)
+            batch['arrivals'].append(arrival)
+            batch['rows'].append(row)
+        if len(batch['rows']) >= max_events or time.monotonic() - batch_started >= max_latency:
+            flush()
+    flush()
+
+    latency = {}
+    if latencies:
+        latency = {name: round(float(np.percentile(latencies, q)), 3) for name, q in [("p50", 50), ("p99", 99)]}
+        latency["max"] = round(max(latencies), 3)
+        emit_metrics({"Source": "stream"}, {
+            "StreamLatencyP50": (int(latency['p50'] * 1000), "Milliseconds"),
+            "StreamLatencyP99": (int(latency['p99'] * 1000), "Milliseconds"),
+            "StreamRows": (len(latencies), "Count")
+        })
+    emit_metrics({"Source": "stream"}, {
+        "StreamRecords": (len(event.get('Records', [])), "Count"),
+        "StreamRecordFailures": (len(batch_item_failures), "Count")
+    })
+    for reason, count in app.reject_counts.items():
+        emit_metrics({"RejectReason": reason}, {"RejectedRows": (count, "Count")})
+    return {"batchItemFailures": batch_item_failures, "responses": responses, "latency_seconds": latency}
+
 # if __name__ == "__main__":
 #     response = lambda_handler(get_sample_event(), None)
     
\ No newline at end of file
@@ -0,0 +1,123 @@
+"""
+Suppression index of opted-out customers used by the Meta conversions lambda to exclude rows before upload
+Also a command line tool to build the index file from a list of identifiers or SHA-256 hashes
+
+Index file layout is a fixed width binary file that can be memory-mapped
+    8 bytes   magic METASUP1
+    8 bytes   number of keys, little endian unsigned
+    n*8 bytes sorted unique keys, little endian unsigned
+A key is the first 8 bytes of the SHA-256 hash of the normalized (trimmed, lower case) identifier
+
+Build an index and upload it to the configured s3 uri
+    python suppression_index.py --input opt_outs.csv --column email --output opt_outs.idx
+    python suppression_index.py --input opt_out_hashes.txt --prehashed --output opt_outs.idx
+    aws s3 cp opt_outs.idx s3://<bucket>/suppression/opt_outs.idx
+"""
+import argparse
+import csv
+import hashlib
+import numpy as np
+
+index_magic = b'METASUP1'
+header_size = 16
+key_dtype = np.dtype('<u8')
+
+def normalize_identifier(value: str) -> str:
+    """
+    Normalizes an identifier the way meta expects before hashing
+    """
+    return value.strip().lower()
+
+def hash_key(value: str, prehashed: bool=False) -> int:
+    """
+    Returns the index key of an identifier, prehashed values are hex encoded SHA-256 hashes
+    """
+    if prehashed:
+        digest = bytes.fromhex(value.strip())
+    else:
+        digest = hashlib.sha256(normalize_identifier(value).encode('utf8')).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+def hash_keys(values, prehashed: bool=False) -> np.ndarray:
+    """
+    Returns the index keys of an iterable of identifiers as an array
+    """
+    return np.fromiter((hash_key(value, prehashed) for value in values), dtype=key_dtype)
+
+def build_index(values, output_path: str, prehashed: bool=False) -> int:
+    """
+    Writes the sorted index file of the identifiers and returns the number of unique keys
+    """
+    keys = np.unique(hash_keys(values, prehashed))
+    with open(output_path, 'wb') as index_file:
+        index_file.write(index_magic)
+        index_file.write(len(keys).to_bytes(8, 'little'))
+        index_file.write(keys.astype(key_dtype).tobytes())
+    return len(keys)
+
+class SuppressionIndex:
+    """
+    Memory-mapped suppression index with vectorized membership tests
+    Keys stay in the page cache instead of the python heap, so tens of millions of keys fit in a lambda
+    """
+    def __init__(self, path: str):
+        """
+        Construct new SuppressionIndex from an index file
+        :param path: local path of the index file
+        """
+        with open(path, 'rb') as index_file:
+            header = index_file.read(header_size)
+        if len(header) != header_size or header[:8] != index_magic:
+            raise ValueError(f"{path} is not a suppression index file")
+        self.path = path
+        count = int.from_bytes(header[8:], 'little')
+        if count:
+            self.keys = np.memmap(path, dtype=key_dtype, mode='r', offset=header_size, shape=(count,))
+        else:
+            self.keys = np.empty(0, dtype=key_dtype)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def close(self) -> None:
+        """
+        Drops the memory map, the file can be removed afterwards
+        """
+        self.keys = np.empty(0, dtype=key_dtype)
+
+    def contains(self, keys: np.ndarray) -> np.ndarray:
+        """
+        Returns a boolean array that is True for the keys present in the index
+        """
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=bool)
+        positions = np.searchsorted(self.keys, keys)
+        found = np.minimum(positions, len(self.keys) - 1)
+        return (positions < len(self.keys)) & (self.keys[found] == keys)
+
+def read_identifiers(input_path: str, column: str=None):
+    """
+    Yields identifiers from a csv file column or from a file with one identifier per line
+    """
+    with open(input_path, newline='', encoding='utf8') as input_file:
+        if column:
+            for row in csv.DictReader(input_file):
+                if row.get(column):
+                    yield row[column]
+        else:
+            for line in input_file:
+                if line.strip():
+                    yield line
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds a suppression index file of opted-out customers")
+    parser.add_argument("--input", required=True, help="csv file or file with one identifier per line")
+    parser.add_argument("--output", required=True, help="index file to write")
+    parser.add_argument("--column", help="csv column holding the identifier, omit for one identifier per line")
+    parser.add_argument("--prehashed", action="store_true", help="identifiers are hex encoded SHA-256 hashes")
+    args = parser.parse_args()
+    count = build_index(read_identifiers(args.input, args.column), args.output, args.prehashed)
+    print(f"wrote {count} keys to {args.output}")
+
+if __name__ == "__main__":
+    main()
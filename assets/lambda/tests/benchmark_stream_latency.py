@@ -0,0 +1,101 @@
+"""
+Benchmark harness of the streaming lambda, reports p50/p99 end to end latency from record arrival to meta response
+Records arrive at a fixed rate and are grouped in to invocations the way the Kinesis event source does, an
+invocation starts when batch_size records are buffered or batching_window seconds after its first record
+Rows are built and encoded by the lambda code, only the meta request is replaced by a stand-in with a fixed latency
+    cd assets/lambda
+    python tests/benchmark_stream_latency.py --records 5000 --rate 500 --batch-size 500 --window 1
+"""
+import argparse
+import base64
+import configparser
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "meta_conversions"))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import send_conversion_events  # noqa: E402
+from send_conversion_events import MetaAWSAMTConnector  # noqa: E402
+
+
+def get_row(index: int) -> dict:
+    return {"c_customer_id": f"customer{index}", "c_first_name": "first", "c_last_name": "last",
+        "c_birth_day": 5, "c_birth_month": 3, "c_birth_year": 1980, "c_email_address": f"customer{index}@example.com"}
+
+def get_invocations(records: int, rate: float, batch_size: int, window: float) -> list:
+    """
+    Returns (invocation start, [(sequence number, arrival)]) pairs in simulated seconds
+    """
+    invocations = []
+    batch = []
+    for index in range(records):
+        arrival = index / rate
+        if batch and arrival > batch[0][1] + window:
+            invocations.append((batch[0][1] + window, batch))
+            batch = []
+        batch.append((str(index), arrival))
+        if len(batch) == batch_size:
+            invocations.append((arrival, batch))
+            batch = []
+    if batch:
+        invocations.append((batch[0][1] + window, batch))
+    return invocations
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures end to end latency of the streaming lambda")
+    parser.add_argument("--records", type=int, default=5000, help="records produced")
+    parser.add_argument("--rate", type=float, default=500, help="records produced per second")
+    parser.add_argument("--batch-size", type=int, default=500, help="streaming_batch_size of the event source")
+    parser.add_argument("--window", type=float, default=1, help="streaming_max_batching_window_seconds")
+    parser.add_argument("--max-events", type=int, default=1000, help="streaming max_events config")
+    parser.add_argument("--max-latency-ms", type=int, default=1000, help="streaming max_latency_ms config")
+    parser.add_argument("--send-latency-ms", type=float, default=150, help="latency of the meta stand-in")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read_dict({
+        "conversions": {"pixel_id": "123", "access_token": "stand-in"},
+        "streaming": {"max_events": str(args.max_events), "max_latency_ms": str(args.max_latency_ms)},
+    })
+    send_conversion_events.load_config = lambda path: config
+    # meta stand-in, the rest of the send path runs unchanged
+    MetaAWSAMTConnector.execute_event_request = lambda self, event_request: (
+        time.sleep(args.send_latency_ms / 1000) or {"events_received": len(event_request.events)})
+    send_conversion_data = MetaAWSAMTConnector.send_conversion_data
+    completed = {}
+    handler_start = [0.0]
+
+    def timed_send_conversion_data(self, chunk_id, df_chunk):
+        response = send_conversion_data(self, chunk_id, df_chunk)
+        offset = time.monotonic() - handler_start[0]
+        completed.update((key.split(":")[0], offset) for key in df_chunk.index)
+        return response
+    MetaAWSAMTConnector.send_conversion_data = timed_send_conversion_data
+
+    latencies = []
+    requests = 0
+    for invocation_start, batch in get_invocations(args.records, args.rate, args.batch_size, args.window):
+        event = {"Records": [{"kinesis": {"sequenceNumber": sequence_number, "approximateArrivalTimestamp": time.time(),
+            "data": base64.b64encode(json.dumps(get_row(int(sequence_number))).encode()).decode()}}
+            for sequence_number, arrival in batch]}
+        completed.clear()
+        handler_start[0] = time.monotonic()
+        response = send_conversion_events.stream_handler(event, None)
+        requests += len(response["responses"])
+        latencies.extend(invocation_start - arrival + completed[sequence_number] for sequence_number, arrival in batch)
+
+    print(json.dumps({
+        "records": len(latencies),
+        "requests": requests,
+        "p50_seconds": round(float(np.percentile(latencies, 50)), 3),
+        "p99_seconds": round(float(np.percentile(latencies, 99)), 3),
+        "max_seconds": round(max(latencies), 3),
+    }))
+
+if __name__ == "__main__":
+    main()
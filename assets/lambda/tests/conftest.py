@@ -0,0 +1,8 @@
+"""
+Makes the lambda code importable by the unit tests, module level boto3 clients need a region
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "meta_conversions"))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
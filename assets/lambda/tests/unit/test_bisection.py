@@ -0,0 +1,109 @@
+import configparser
+import json
+
+import pytest
+from facebook_business.exceptions import FacebookRequestError
+
+from send_conversion_events import MetaAWSAMTConnector
+
+
+def get_error(code: int=100, http_status: int=400) -> FacebookRequestError:
+    return FacebookRequestError("rejected", {}, http_status, {},
+        json.dumps({"error": {"code": code, "message": "Invalid parameter"}}))
+
+@pytest.fixture
+def connector(monkeypatch):
+    connector = MetaAWSAMTConnector(configparser.ConfigParser())
+    connector.written_rejects = []
+    monkeypatch.setattr(connector, "write_rejects",
+        lambda stage, chunk_id, body, count: connector.written_rejects.extend(body.decode().splitlines()))
+    return connector
+
+def get_sender(requests: list, bad_items: set, code: int=100):
+    def send_items(items):
+        requests.append(list(items))
+        if bad_items.intersection(items):
+            raise get_error(code)
+        return {"events_received": len(items), "fbtrace_id": "trace"}
+    return send_items
+
+def test_bisection_isolates_rejected_events(connector):
+    requests = []
+    response = connector.send_with_bisection(list(range(16)), get_sender(requests, {5, 11}), lambda item: item, 0)
+
+    assert response["events_received"] == 14
+    assert response["rejected_events"] == 2
+    # one request per node of the two paths down to the bad events and their siblings
+    assert response["requests"] == len(requests) == 15
+    assert [json.loads(record)["event"] for record in connector.written_rejects] == [5, 11]
+    assert connector.reject_counts["rejected_by_meta"] == 2
+
+def test_bisection_sends_valid_request_once(connector):
+    requests = []
+    response = connector.send_with_bisection(list(range(16)), get_sender(requests, set()), lambda item: item, 0)
+
+    assert requests == [list(range(16))]
+    assert response["events_received"] == 16
+    assert response["rejected_events"] == 0
+    assert connector.written_rejects == []
+
+def test_bisection_does_not_split_token_errors(connector):
+    requests = []
+    with pytest.raises(FacebookRequestError):
+        connector.send_with_bisection(list(range(16)), get_sender(requests, {3}, code=190), lambda item: item, 0)
+    assert len(requests) == 1
+
+def test_send_event_request_rebuilds_requests_for_the_same_pixel(connector, monkeypatch):
+    connector.source_bucket, connector.source_key = "bucket", "key.csv"
+    df_chunk = connector.rows_to_df([{"c_customer_id": f"customer{index}", "c_birth_day": 5, "c_birth_month": 3,
+        "c_birth_year": 1980, "c_email_address": f"customer{index}@example.com"} for index in range(4)])
+    requests = []
+
+    def execute_event_request(event_request):
+        requests.append((event_request.pixel_id, len(event_request.events)))
+        if len(event_request.events) > 1:
+            raise get_error()
+        return {"events_received": 1}
+    monkeypatch.setattr(connector, "execute_event_request", execute_event_request)
+    events = connector.build_events(0, connector.narrow_dtypes(df_chunk))
+    response = connector.send_event_request(connector.get_event_request(events, "123"), 0)
+
+    assert response["events_received"] == 4
+    assert {pixel_id for pixel_id, count in requests} == {"123"}
+
+def test_bisection_of_only_bad_events_is_capped(connector):
+    requests = []
+    response = connector.send_with_bisection(list(range(1000)), get_sender(requests, set(range(1000))),
+        lambda item: item, 0)
+
+    # breadth first down to the cap instead of 2n-1 requests
+    assert response["requests"] == len(requests) == 64
+    assert max(len(part) for part in requests[-32:]) <= 32
+    assert response["events_received"] == 0
+    assert response["rejected_events"] == 1000
+    assert sorted(json.loads(record)["event"] for record in connector.written_rejects) == list(range(1000))
+    assert connector.reject_counts["rejected_by_meta"] + connector.reject_counts["bisection_capped"] == 1000
+
+def test_bisection_cap_is_configurable(connector):
+    connector.config.read_dict({"bisection": {"max_requests": "5"}})
+    requests = []
+    response = connector.send_with_bisection(list(range(16)), get_sender(requests, {5}), lambda item: item, 0)
+
+    assert len(requests) == 5
+    assert response["events_received"] == 12
+    # the bad event is in one of the two unsent pairs
+    assert response["rejected_events"] == 4
+    assert 5 in [json.loads(record)["event"] for record in connector.written_rejects]
+
+def test_encoded_events_share_one_request_budget(connector, monkeypatch):
+    requests = []
+
+    def execute_encoded_request(pixel_id, data, events_count):
+        items = json.loads(data)
+        requests.append(items)
+        raise get_error()
+    monkeypatch.setattr(connector, "execute_encoded_request", execute_encoded_request)
+    response = connector.send_encoded_events("123", json.dumps(list(range(1000))).encode(), 1000, 0)
+
+    assert response["requests"] == len(requests) == 64
+    assert response["rejected_events"] == 1000
@@ -0,0 +1,75 @@
+import configparser
+import io
+import json
+
+import pandas as pd
+import pytest
+
+from send_conversion_events import MetaAWSAMTConnector
+
+header = "c_customer_id,c_first_name,c_last_name,c_birth_day,c_birth_month,c_birth_year,c_email_address,ss_net_paid"
+
+def get_csv(rows: int, birth_days: dict=None) -> bytes:
+    birth_days = birth_days or {}
+    lines = [header] + [
+        f"customer{index},first,last,{birth_days.get(index, 5)},3,1980,customer{index}@example.com,6000.5"
+        for index in range(rows)
+    ]
+    return ("\n".join(lines) + "\n").encode("utf8")
+
+def get_connector(monkeypatch, data: bytes, engine: str="pyarrow") -> MetaAWSAMTConnector:
+    config = configparser.ConfigParser()
+    config.read_dict({"reader": {"engine": engine}})
+    connector = MetaAWSAMTConnector(config)
+    connector.source_bucket, connector.source_key = "bucket", "key.csv"
+    monkeypatch.setattr(connector, "open_source_stream", lambda compression, in_memory: io.BytesIO(data))
+    monkeypatch.setattr(connector, "write_rejects", lambda stage, chunk_id, body, count: None)
+    return connector
+
+@pytest.mark.parametrize("engine", ["pyarrow", "pandas"])
+def test_malformed_date_parts_only_reject_their_rows(monkeypatch, engine):
+    connector = get_connector(monkeypatch, get_csv(20, {3: "xx", 7: "300", 11: "", 12: "4.5"}), engine)
+    connector.set_df_iterator(chunksize=8, in_memory=True)
+    chunks = [connector.prepare_conversion_chunk(i, df_chunk) for i, df_chunk in enumerate(connector.iterate_df_chunks())]
+    prepared = pd.concat(chunks)
+
+    assert "ss_net_paid" not in prepared.columns
+    assert sorted(set(range(20)) - set(prepared.index)) == [3, 7, 11, 12]
+    assert connector.reject_counts["invalid_birth_day"] == 4
+    assert prepared["c_birth_day"].dtype == pd.Int8Dtype()
+    assert prepared["c_birth_year"].dtype == pd.Int16Dtype()
+    assert connector.format_dob_digits(prepared["c_birth_day"].iloc[0], 'd') == "05"
+
+@pytest.mark.parametrize("limit_rows,chunksize", [(100, 7), (5, 7), (14, 7), (None, 7)])
+def test_arrow_reader_limit_rows(monkeypatch, limit_rows, chunksize):
+    connector = get_connector(monkeypatch, get_csv(250))
+    chunks = list(connector.read_csv_arrow(io.BytesIO(get_csv(250)), chunksize, ",", "utf8", limit_rows))
+    expected = 250 if limit_rows is None else limit_rows
+
+    assert sum(len(chunk.index) for chunk in chunks) == expected
+    assert all(len(chunk.index) == chunksize for chunk in chunks[:-1])
+    assert list(pd.concat(chunks).index) == list(range(expected))
+
+def test_arrow_reader_limit_rows_across_blocks(monkeypatch):
+    connector = get_connector(monkeypatch, b"")
+    data = get_csv(200000)
+    chunks = list(connector.read_csv_arrow(io.BytesIO(data), 7, ",", "utf8", 100000))
+
+    assert sum(len(chunk.index) for chunk in chunks) == 100000
+
+@pytest.mark.parametrize("engine", ["pyarrow", "pandas"])
+def test_rows_missing_one_identifier_build_valid_events(monkeypatch, engine):
+    lines = [header, "customer0,first,last,5,3,1980,,6000.5", ",first,,5,3,1980,customer1@example.com,6000.5",
+        ",first,last,5,3,1980,,6000.5"]
+    connector = get_connector(monkeypatch, ("\n".join(lines) + "\n").encode("utf8"), engine)
+    connector.set_df_iterator(chunksize=8, in_memory=True)
+    prepared = connector.prepare_conversion_chunk(0, next(connector.iterate_df_chunks()))
+    events = [event.normalize() for event in connector.build_events(0, prepared)]
+
+    assert list(prepared.index) == [0, 1]
+    assert connector.reject_counts["missing_identifier"] == 1
+    # the request body must serialize, missing values are left out instead of sent as NA
+    body = json.dumps(events)
+    assert "<NA>" not in body
+    assert "em" not in events[0]["user_data"] and "external_id" in events[0]["user_data"]
+    assert "external_id" not in events[1]["user_data"] and "ln" not in events[1]["user_data"]
@@ -0,0 +1,38 @@
+import configparser
+import os
+import sys
+
+from send_conversion_events import MetaAWSAMTConnector
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "..", "glue"))
+from meta_direct_upload import build_conversion_event  # noqa: E402
+
+row = {"c_customer_id": "customer1", "c_first_name": "first", "c_last_name": "last", "c_birth_day": 5,
+    "c_birth_month": 3, "c_birth_year": 1980, "c_email_address": "customer1@example.com", "ss_net_paid": 6000.5}
+
+def get_lambda_event() -> dict:
+    connector = MetaAWSAMTConnector(configparser.ConfigParser())
+    connector.source_bucket, connector.source_key = "bucket", "key.csv"
+    df_chunk = connector.narrow_dtypes(connector.rows_to_df([row]))
+    return connector.build_events(0, connector.get_needed_cols_df_chunk(df_chunk))[0].normalize()
+
+def test_glue_events_match_the_lambda_payload():
+    lambda_event = get_lambda_event()
+    glue_event = build_conversion_event(row, lambda_event["event_time"], "run1")
+
+    assert glue_event["user_data"] == lambda_event["user_data"]
+    assert {key: value for key, value in glue_event.items() if key not in ("event_id", "custom_data")} == {
+        key: value for key, value in lambda_event.items() if key not in ("event_id", "custom_data")}
+    assert glue_event["custom_data"]["contents"] == lambda_event["custom_data"]["contents"]
+    assert glue_event["custom_data"]["value"] == 6000.5
+
+def test_glue_event_ids_are_per_run_and_row():
+    event_id = build_conversion_event(row, 0, "run1")["event_id"]
+
+    assert build_conversion_event(row, 1, "run1")["event_id"] == event_id
+    # a repeat purchase of the same customer in a later run is not deduplicated
+    assert build_conversion_event(row, 0, "run2")["event_id"] != event_id
+    assert build_conversion_event(dict(row, ss_net_paid=7000.0), 0, "run1")["event_id"] != event_id
+    rows_without_id = [dict(row, c_customer_id=None, c_email_address=f"customer{index}@example.com") for index in range(2)]
+    assert len({build_conversion_event(item, 0, "run1")["event_id"] for item in rows_without_id}) == 2
+    assert "external_id" not in build_conversion_event(rows_without_id[0], 0, "run1")["user_data"]
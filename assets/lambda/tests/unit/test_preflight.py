@@ -0,0 +1,85 @@
+import configparser
+import json
+
+import pytest
+from facebook_business.exceptions import FacebookRequestError
+
+from send_conversion_events import MetaAWSAMTConnector, PreflightFailed
+from suppression_index import SuppressionIndex, build_index
+
+
+def get_error(code: int=100, http_status: int=400) -> FacebookRequestError:
+    return FacebookRequestError("rejected", {}, http_status, {},
+        json.dumps({"error": {"code": code, "message": "Invalid parameter"}}))
+
+def get_rows(rows: int, bad_rows: set=frozenset()) -> list:
+    return [{"c_customer_id": f"customer{index}", "c_first_name": "first", "c_last_name": "last",
+        "c_birth_day": "xx" if index in bad_rows else 5, "c_birth_month": 3, "c_birth_year": 1980,
+        "c_email_address": f"customer{index}@example.com"} for index in range(rows)]
+
+@pytest.fixture
+def connector(monkeypatch):
+    config = configparser.ConfigParser()
+    config.read_dict({"conversions": {"pixel_id": "123"}})
+    connector = MetaAWSAMTConnector(config)
+    connector.source_bucket, connector.source_key = "bucket", "key.csv"
+    connector.suppression_index_loaded = True
+    connector.requests = []
+    monkeypatch.setattr(connector, "write_rejects", lambda stage, chunk_id, body, count: None)
+    monkeypatch.setattr(connector, "execute_event_request", lambda event_request: connector.requests.append(
+        len(event_request.events)) or {"events_received": len(event_request.events)})
+    return connector
+
+def set_chunks(connector: MetaAWSAMTConnector, rows: list, chunksize: int=100) -> None:
+    connector.df_terator = iter([connector.rows_to_df(rows[start:start + chunksize])
+        for start in range(0, len(rows), chunksize)])
+
+def test_preflight_passes_and_keeps_the_rest_of_the_object(connector):
+    set_chunks(connector, get_rows(120))
+    result = connector.run_preflight()
+
+    assert result["sample_rows"] == 50
+    assert result["events_received"] == result["events_sent"] == 50
+    assert connector.requests == [10] * 5
+    # sample rows are not sent again
+    assert [len(chunk.index) for chunk in connector.df_terator] == [50, 20]
+
+def test_preflight_fails_on_reject_rate(connector):
+    set_chunks(connector, get_rows(100, bad_rows=set(range(10))))
+    with pytest.raises(PreflightFailed, match="invalid_birth_day"):
+        connector.run_preflight()
+    assert connector.requests == []
+
+def test_preflight_does_not_count_suppressed_rows_as_rejects(connector, tmp_path):
+    index_path = str(tmp_path / "opt_outs.idx")
+    build_index([f"customer{index}@example.com" for index in range(20)], index_path)
+    connector.suppression_index = SuppressionIndex(index_path)
+    set_chunks(connector, get_rows(100, bad_rows={30}))
+    result = connector.run_preflight()
+
+    assert result["suppressed_rows"] == 20
+    assert result["rejected_rows"] == 1
+    assert result["events_sent"] == 29
+
+def test_preflight_fails_on_acceptance_rate(connector, monkeypatch):
+    def execute_event_request(event_request):
+        connector.requests.append(len(event_request.events))
+        if len(connector.requests) > 1:
+            raise get_error()
+        return {"events_received": len(event_request.events)}
+    monkeypatch.setattr(connector, "execute_event_request", execute_event_request)
+    set_chunks(connector, get_rows(100))
+    with pytest.raises(PreflightFailed, match="acceptance rate 0.2"):
+        connector.run_preflight()
+    # probe requests are not bisected
+    assert connector.requests == [10] * 5
+
+def test_preflight_fails_at_once_on_token_errors(connector, monkeypatch):
+    def execute_event_request(event_request):
+        connector.requests.append(len(event_request.events))
+        raise get_error(190, 401)
+    monkeypatch.setattr(connector, "execute_event_request", execute_event_request)
+    set_chunks(connector, get_rows(100))
+    with pytest.raises(PreflightFailed, match="error 190"):
+        connector.run_preflight()
+    assert connector.requests == [10]
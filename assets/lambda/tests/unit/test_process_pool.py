@@ -0,0 +1,36 @@
+import configparser
+import threading
+
+from send_conversion_events import MetaAWSAMTConnector
+
+
+def get_chunk(start: int, rows: int):
+    # long names make both the pickled chunk and the encoded body larger than a pipe buffer
+    return MetaAWSAMTConnector.rows_to_df([{
+        "c_customer_id": f"customer{index}",
+        "c_first_name": "first" * 40,
+        "c_last_name": "last" * 50,
+        "c_birth_day": 5,
+        "c_birth_month": 3,
+        "c_birth_year": 1980,
+        "c_email_address": f"customer{index}@example.com",
+    } for index in range(start, start + rows)], list(range(start, start + rows)))
+
+def test_process_pool_sends_large_chunks_without_deadlock(monkeypatch):
+    config = configparser.ConfigParser()
+    config.read_dict({"conversions": {"pixel_id": "123"}})
+    connector = MetaAWSAMTConnector(config)
+    connector.source_bucket, connector.source_key = "bucket", "key.csv"
+    connector.df_terator = [get_chunk(start, 500) for start in range(0, 2000, 500)]
+    sent = []
+    monkeypatch.setattr(connector, "send_encoded_events",
+        lambda pixel_id, data, events_count, chunk_id: sent.append((chunk_id, events_count)) or {"events_received": events_count})
+    result = {}
+    runner = threading.Thread(target=lambda: result.update(connector.iterate_conversion_data_process_pool(1, 2)),
+        daemon=True)
+    runner.start()
+    runner.join(timeout=60)
+
+    assert not runner.is_alive(), "process pool did not finish"
+    assert sorted(sent) == [(0, 500), (1, 500), (2, 500), (3, 500)]
+    assert len(result["responses"]) == 4
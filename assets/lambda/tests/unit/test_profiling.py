@@ -0,0 +1,81 @@
+import configparser
+import io
+import json
+import pstats
+import tempfile
+from types import SimpleNamespace
+
+import pytest
+from facebook_business.adobjects.serverside.event_request import EventRequest
+
+import send_conversion_events
+
+
+class FakeS3:
+    """
+    Serves one csv object and keeps the objects put by the profiler
+    """
+    def __init__(self, body: bytes):
+        self.body = body
+        self.objects = {}
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.body)}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+def get_csv(rows: int) -> bytes:
+    lines = ["c_customer_id,c_first_name,c_last_name,c_birth_day,c_birth_month,c_birth_year,c_email_address"]
+    lines.extend(f"customer{index},first,last,5,3,1980,customer{index}@example.com" for index in range(rows))
+    return '\n'.join(lines).encode()
+
+def get_object_event(size: int) -> dict:
+    return {"detail": {"bucket": {"name": "audiences"}, "object": {"key": "audience.csv", "size": size}}}
+
+@pytest.fixture
+def fake_s3(monkeypatch):
+    fake_s3 = FakeS3(get_csv(2500))
+    monkeypatch.setattr(send_conversion_events, "s3_client", fake_s3)
+    # only the http request is replaced, so the send stage is profiled
+    monkeypatch.setattr(EventRequest, "execute",
+        lambda self: SimpleNamespace(to_dict=lambda: {"events_received": len(self.events)}))
+    return fake_s3
+
+def get_config(mode: str) -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+    config.read_dict({
+        "conversions": {"pixel_id": "123", "access_token": "token"},
+        "profiling": {"enabled": "True", "mode": mode, "memory": "True", "s3_prefix": "s3://profiles/runs",
+            "sampling_interval_ms": "1"},
+    })
+    return config
+
+@pytest.mark.parametrize("mode", ["cprofile", "sampling"])
+def test_profiled_pipelined_upload_writes_artifacts(fake_s3, mode):
+    context = SimpleNamespace(aws_request_id="request")
+    response = send_conversion_events.process_object_event(
+        get_object_event(send_conversion_events.large_object_min_bytes), context, get_config(mode))
+
+    assert sum(item["events_received"] for item in response["responses"]) == 2500
+    summary = json.loads(fake_s3.objects["runs/request/summary.json"])
+    assert summary["mode"] == mode
+    assert {"read", "build", "send"} <= set(summary["stage_seconds"])
+    assert "runs/request/send.memory.json" in fake_s3.objects
+    if mode == "cprofile":
+        assert b"cumulative" in fake_s3.objects["runs/request/send.txt"]
+        with tempfile.NamedTemporaryFile() as stats_file:
+            stats_file.write(fake_s3.objects["runs/request/send.pstats"])
+            stats_file.flush()
+            assert pstats.Stats(stats_file.name).total_calls > 0
+    else:
+        assert any(key.endswith(".collapsed.txt") for key in fake_s3.objects)
+
+def test_profiling_failure_does_not_fail_the_upload(fake_s3, monkeypatch):
+    def fail_put_object(Bucket, Key, Body):
+        raise RuntimeError("access denied")
+    monkeypatch.setattr(fake_s3, "put_object", fail_put_object)
+    response = send_conversion_events.process_object_event(
+        get_object_event(send_conversion_events.large_object_min_bytes), None, get_config("cprofile"))
+
+    assert sum(item["events_received"] for item in response["responses"]) == 2500
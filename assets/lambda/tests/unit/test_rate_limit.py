@@ -0,0 +1,98 @@
+import copy
+
+import pytest
+from botocore.exceptions import ClientError
+
+import send_conversion_events
+from send_conversion_events import DistributedTokenBucket, TokenBucket
+
+
+class FakeClock:
+    """
+    Replaces the time module of the lambda code, sleeping advances the clock
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        # a real sleep takes at least a few microseconds, rounding leftovers of the refill math would not advance
+        self.now += max(seconds, 1e-6)
+
+class FakeDynamoDB:
+    """
+    In memory table with the conditional update semantics the distributed token bucket relies on
+    """
+    def __init__(self):
+        self.items = {}
+        self.updates = 0
+
+    def get_item(self, TableName, Key, ConsistentRead):
+        item = self.items.get(Key['bucket_key']['S'])
+        return {'Item': copy.deepcopy(item)} if item else {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression, ExpressionAttributeValues):
+        key = Key['bucket_key']['S']
+        item = self.items.get(key)
+        if ConditionExpression == 'attribute_not_exists(bucket_key)':
+            passed = item is None
+        else:
+            passed = item is not None and item['last_refill'] == ExpressionAttributeValues[':last_refill']
+        if not passed:
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+        self.updates += 1
+        self.items[key] = {'bucket_key': {'S': key}, 'tokens': ExpressionAttributeValues[':tokens'],
+            'last_refill': ExpressionAttributeValues[':now']}
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(send_conversion_events, "time", clock)
+    return clock
+
+def get_bucket(table: FakeDynamoDB, rate: float, block_size: int=1000) -> DistributedTokenBucket:
+    bucket = DistributedTokenBucket("rate-limit", "pixel", rate, block_size=block_size)
+    bucket.dynamodb = table
+    return bucket
+
+@pytest.mark.parametrize("rate,tokens", [(100, 100), (100, 10), (5000, 100), (100, 250)])
+def test_distributed_bucket_stays_under_rate(clock, rate, tokens):
+    bucket = get_bucket(FakeDynamoDB(), rate)
+    start = clock.now
+    events = 0
+    for _ in range(50):
+        bucket.acquire(tokens)
+        events += tokens
+    # one second of burst capacity plus the refill rate
+    assert events <= rate + rate * (clock.now - start) + 1e-6
+
+def test_concurrent_buckets_share_rate(clock):
+    table = FakeDynamoDB()
+    buckets = [get_bucket(table, 200, block_size=50) for _ in range(4)]
+    start = clock.now
+    events = 0
+    for _ in range(100):
+        for bucket in buckets:
+            bucket.acquire(20)
+            events += 20
+    assert events <= 200 + 200 * (clock.now - start) + 1e-6
+    # blocks keep the shared item updates well below one per request
+    assert table.updates < 400
+
+def test_local_bucket_stays_under_rate(clock):
+    bucket = TokenBucket(100)
+    start = clock.now
+    events = 0
+    for _ in range(100):
+        bucket.acquire(30)
+        events += 30
+    assert events <= 100 + 100 * (clock.now - start) + 1e-6
+
+def test_zero_rate_does_not_limit(clock):
+    assert get_bucket(FakeDynamoDB(), 0).acquire(10 ** 6) == 0.0
+    assert TokenBucket(0).acquire(10 ** 6) == 0.0
@@ -0,0 +1,61 @@
+import configparser
+
+import pandas as pd
+import pytest
+
+from send_conversion_events import ConversionSink, MetaAWSAMTConnector
+
+
+class RecordingSink(ConversionSink):
+    def send_batch(self, batch_id, df_batch):
+        if batch_id in self.failing_batches:
+            raise RuntimeError("rejected")
+        return len(df_batch.index)
+
+def get_connector(monkeypatch, **settings) -> MetaAWSAMTConnector:
+    config = configparser.ConfigParser()
+    config.read_dict({"sink_recording": settings})
+    connector = MetaAWSAMTConnector(config)
+    connector.written_rejects = []
+    monkeypatch.setattr(connector, "write_rejects",
+        lambda stage, chunk_id, body, count: connector.written_rejects.append((stage, chunk_id, count)))
+    return connector
+
+def get_sink(connector, failing_batches=()) -> RecordingSink:
+    sink = RecordingSink("recording", connector)
+    sink.failing_batches = set(failing_batches)
+    return sink
+
+def test_sink_without_send_batch_fails_on_construction(monkeypatch):
+    class IncompleteSink(ConversionSink):
+        pass
+
+    with pytest.raises(TypeError):
+        IncompleteSink("incomplete", get_connector(monkeypatch))
+
+def test_sink_regroups_chunks_in_to_batches(monkeypatch):
+    sink = get_sink(get_connector(monkeypatch, batch_size="7"))
+    for rows in [3, 5, 20, 1]:
+        sink.add_chunk(pd.DataFrame({"value": range(rows)}))
+    summary = sink.close()
+
+    assert summary["requests"] == 5
+    assert summary["rows_sent"] == 29
+    assert sorted(summary["responses"]) == [1, 7, 7, 7, 7]
+
+def test_sink_continue_policy_rejects_failed_batches(monkeypatch):
+    connector = get_connector(monkeypatch, batch_size="7", failure_policy="continue")
+    sink = get_sink(connector, failing_batches={2})
+    sink.add_chunk(pd.DataFrame({"value": range(29)}))
+    summary = sink.close()
+
+    assert summary["failed_batches"] == 1
+    assert summary["failed_rows"] == 7
+    assert summary["rows_sent"] == 22
+    assert connector.written_rejects == [("sink-recording", 2, 7)]
+
+def test_sink_raise_policy_fails_on_failed_batch(monkeypatch):
+    sink = get_sink(get_connector(monkeypatch, batch_size="7"), failing_batches={0})
+    sink.add_chunk(pd.DataFrame({"value": range(10)}))
+    with pytest.raises(RuntimeError):
+        sink.close()
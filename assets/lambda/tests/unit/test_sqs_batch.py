@@ -0,0 +1,78 @@
+import configparser
+import json
+
+import pytest
+
+import send_conversion_events
+
+queue_arn = "arn:aws:sqs:us-east-1:123456789012:ingestion"
+
+class FakeContext:
+    """
+    Lambda context, the stand-in of process_object_event takes the processing time off the remaining time
+    """
+    def __init__(self, remaining_ms: int):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self) -> int:
+        return self.remaining_ms
+
+class FakeSQS:
+    def __init__(self, fail_ids: set=frozenset()):
+        self.fail_ids = fail_ids
+        self.sent = []
+
+    def get_queue_url(self, QueueName, QueueOwnerAWSAccountId):
+        return {"QueueUrl": f"https://sqs.us-east-1.amazonaws.com/{QueueOwnerAWSAccountId}/{QueueName}"}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        successful = [entry for entry in Entries if json.loads(entry["MessageBody"])["detail"]["object"]["key"]
+            not in self.fail_ids]
+        self.sent.extend(json.loads(entry["MessageBody"])["detail"]["object"]["key"] for entry in successful)
+        return {"Successful": [{"Id": entry["Id"]} for entry in successful]}
+
+def get_record(key: str, size: int) -> dict:
+    body = {"detail": {"bucket": {"name": "audiences"}, "object": {"key": key, "size": size}}}
+    return {"messageId": key, "body": json.dumps(body), "eventSourceARN": queue_arn, "receiptHandle": f"handle-{key}"}
+
+@pytest.fixture
+def processed(monkeypatch):
+    monkeypatch.setattr(send_conversion_events, "load_config", lambda path: configparser.ConfigParser())
+    processed = []
+
+    def process_object_event(event, context, config):
+        processed.append(event["detail"]["object"]["key"])
+        # large objects take 10 minutes, the others one minute
+        context.remaining_ms -= 600000 if event["detail"]["object"]["size"] >= 104857600 else 60000
+        return {"responses": []}
+    monkeypatch.setattr(send_conversion_events, "process_object_event", process_object_event)
+    return processed
+
+def test_records_are_not_started_without_enough_remaining_time(processed, monkeypatch):
+    fake_sqs = FakeSQS()
+    monkeypatch.setattr(send_conversion_events, "sqs_client", fake_sqs)
+    records = [get_record(f"medium{index}", 5000000) for index in range(3)] + [get_record("large0", 200000000),
+        get_record("large1", 200000000)]
+    response = send_conversion_events.lambda_handler({"Records": records}, FakeContext(770000))
+
+    # the large object is started first, the second large object and the last medium object do not fit
+    assert processed == ["large0", "medium0", "medium1"]
+    assert sorted(fake_sqs.sent) == ["large1", "medium2"]
+    # requeued records are new messages, finished and requeued records are not redelivered
+    assert response["batchItemFailures"] == []
+
+def test_records_that_can_not_be_requeued_are_reported(processed, monkeypatch):
+    monkeypatch.setattr(send_conversion_events, "sqs_client", FakeSQS(fail_ids={"medium1"}))
+    records = [get_record(f"medium{index}", 5000000) for index in range(3)]
+    response = send_conversion_events.lambda_handler({"Records": records}, FakeContext(100000))
+
+    assert processed == ["medium0"]
+    assert response["batchItemFailures"] == [{"itemIdentifier": "medium1"}]
+
+def test_records_are_processed_without_a_context(processed, monkeypatch):
+    monkeypatch.setattr(send_conversion_events, "process_object_event",
+        lambda event, context, config: processed.append(event["detail"]["object"]["key"]) or {"responses": []})
+    response = send_conversion_events.lambda_handler({"Records": [get_record("medium0", 5000000)]}, None)
+
+    assert processed == ["medium0"]
+    assert response["batchItemFailures"] == []
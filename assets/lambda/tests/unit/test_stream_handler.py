@@ -0,0 +1,58 @@
+import base64
+import configparser
+import json
+import time
+
+import pytest
+
+import send_conversion_events
+from send_conversion_events import MetaAWSAMTConnector
+
+
+def get_kinesis_record(index: int, arrival: float) -> dict:
+    row = {"c_customer_id": f"customer{index}", "c_first_name": "first", "c_last_name": "last",
+        "c_birth_day": 5, "c_birth_month": 3, "c_birth_year": 1980, "c_email_address": f"customer{index}@example.com"}
+    return {"kinesis": {"sequenceNumber": str(index), "approximateArrivalTimestamp": arrival,
+        "data": base64.b64encode(json.dumps(row).encode()).decode()}}
+
+@pytest.fixture
+def sent_batches(monkeypatch):
+    config = configparser.ConfigParser()
+    config.read_dict({"conversions": {"pixel_id": "123"}, "streaming": {"max_events": "100"}})
+    monkeypatch.setattr(send_conversion_events, "load_config", lambda path: config)
+    sent_batches = []
+
+    def send_conversion_data(self, chunk_id, df_chunk):
+        sent_batches.append(list(df_chunk.index))
+        return {"events_received": len(df_chunk.index)}
+    monkeypatch.setattr(MetaAWSAMTConnector, "send_conversion_data", send_conversion_data)
+    return sent_batches
+
+def test_stream_handler_flushes_full_micro_batches_of_delayed_records(sent_batches):
+    # records waited in the event source batch window longer than the latency deadline
+    arrival = time.time() - 1.2
+    response = send_conversion_events.stream_handler(
+        {"Records": [get_kinesis_record(index, arrival) for index in range(500)]}, None)
+
+    assert [len(batch) for batch in sent_batches] == [100] * 5
+    assert response["batchItemFailures"] == []
+    assert response["latency_seconds"]["p50"] >= 1.2
+    assert response["latency_seconds"]["p99"] >= response["latency_seconds"]["p50"]
+
+def test_stream_handler_flushes_partial_micro_batch_at_the_end(sent_batches):
+    response = send_conversion_events.stream_handler(
+        {"Records": [get_kinesis_record(index, time.time()) for index in range(250)]}, None)
+
+    assert [len(batch) for batch in sent_batches] == [100, 100, 50]
+    # rows are keyed by record id, so retried records get the same event ids
+    assert sent_batches[0][0] == "0:0"
+    assert len(response["responses"]) == 3
+
+def test_stream_handler_reports_failed_micro_batch_records(sent_batches, monkeypatch):
+    def fail_send(self, chunk_id, df_chunk):
+        raise RuntimeError("throttled")
+    monkeypatch.setattr(MetaAWSAMTConnector, "send_conversion_data", fail_send)
+    response = send_conversion_events.stream_handler(
+        {"Records": [get_kinesis_record(index, time.time()) for index in range(150)]}, None)
+
+    assert len(response["batchItemFailures"]) == 150
@@ -0,0 +1,112 @@
+import configparser
+import hashlib
+import os
+import shutil
+import sys
+
+import pytest
+
+import send_conversion_events
+import suppression_index
+from send_conversion_events import MetaAWSAMTConnector
+from suppression_index import SuppressionIndex, build_index, hash_keys
+
+emails = ["Customer1@Example.com ", "customer2@example.com", "customer3@example.com"]
+
+def test_raw_and_prehashed_identifiers_build_the_same_index(tmp_path):
+    raw_path, prehashed_path = str(tmp_path / "raw.idx"), str(tmp_path / "prehashed.idx")
+    hashes = [hashlib.sha256(email.strip().lower().encode()).hexdigest() for email in emails]
+
+    # duplicates after normalization are written once
+    assert build_index(emails + ["customer2@EXAMPLE.com"], raw_path) == 3
+    assert build_index(hashes, prehashed_path, prehashed=True) == 3
+    with open(raw_path, "rb") as raw_file, open(prehashed_path, "rb") as prehashed_file:
+        assert raw_file.read() == prehashed_file.read()
+    index = SuppressionIndex(raw_path)
+    assert len(index) == 3
+    assert list(index.contains(hash_keys(["customer1@example.com", "other@example.com", " CUSTOMER3@example.com"]))) == [
+        True, False, True]
+    assert list(index.contains(hash_keys(hashes[1:2], prehashed=True))) == [True]
+
+def test_empty_index_contains_nothing(tmp_path):
+    path = str(tmp_path / "empty.idx")
+    assert build_index([], path) == 0
+    index = SuppressionIndex(path)
+
+    assert len(index) == 0
+    assert list(index.contains(hash_keys(emails))) == [False] * 3
+
+def test_other_files_are_not_read_as_index(tmp_path):
+    path = tmp_path / "audience.csv"
+    path.write_bytes(b"c_customer_id,c_email_address\n")
+    with pytest.raises(ValueError):
+        SuppressionIndex(str(path))
+
+def test_builder_reads_a_csv_column(tmp_path, monkeypatch, capsys):
+    input_path, output_path = tmp_path / "opt_outs.csv", tmp_path / "opt_outs.idx"
+    input_path.write_text("email,name\ncustomer1@example.com,one\n,two\ncustomer2@example.com,three\n")
+    monkeypatch.setattr(sys, "argv", ["suppression_index.py", "--input", str(input_path), "--column", "email",
+        "--output", str(output_path)])
+    suppression_index.main()
+
+    assert "wrote 2 keys" in capsys.readouterr().out
+    assert list(SuppressionIndex(str(output_path)).contains(hash_keys(emails[:2]))) == [True, True]
+
+def get_connector() -> MetaAWSAMTConnector:
+    config = configparser.ConfigParser()
+    config.read_dict({"suppression": {"s3_uri": "s3://lists/opt_outs.idx"}})
+    return MetaAWSAMTConnector(config)
+
+def test_suppress_opted_out_keeps_rows_without_identifier(tmp_path):
+    path = str(tmp_path / "opt_outs.idx")
+    build_index(emails[:1], path)
+    connector = get_connector()
+    df_chunk = connector.get_needed_cols_df_chunk(connector.rows_to_df([
+        {"c_customer_id": "customer1", "c_email_address": "customer1@example.com"},
+        {"c_customer_id": "customer2", "c_email_address": None},
+        {"c_customer_id": "customer3", "c_email_address": "customer3@example.com"},
+    ]))
+    suppressed = connector.suppress_opted_out(df_chunk, SuppressionIndex(path))
+
+    assert list(suppressed["c_customer_id"]) == ["customer2", "customer3"]
+    assert connector.suppressed_rows == 1
+
+class FakeS3:
+    """
+    Serves index files by etag, the etag of the object is changed by the tests
+    """
+    def __init__(self, files: dict):
+        self.files = files
+        self.etag = None
+        self.downloads = 0
+
+    def head_object(self, Bucket, Key):
+        return {"ETag": f'"{self.etag}"'}
+
+    def download_file(self, bucket, key, local_path):
+        self.downloads += 1
+        shutil.copy(self.files[self.etag], local_path)
+
+def test_index_is_downloaded_again_only_on_etag_change(tmp_path, monkeypatch):
+    files = {}
+    for etag, count in [("etag1", 1), ("etag2", 2)]:
+        files[etag] = str(tmp_path / f"{etag}.idx")
+        build_index(emails[:count], files[etag])
+    fake_s3 = FakeS3(files)
+    monkeypatch.setattr(send_conversion_events, "s3_client", fake_s3)
+    monkeypatch.setattr(send_conversion_events, "suppression_index_cache", {})
+
+    fake_s3.etag = "etag1"
+    first = get_connector().get_suppression_index()
+    assert get_connector().get_suppression_index() is first
+    assert fake_s3.downloads == 1
+
+    fake_s3.etag = "etag2"
+    second = get_connector().get_suppression_index()
+    assert fake_s3.downloads == 2
+    assert len(second) == 2
+    # the file of the previous etag is removed, so /tmp holds one index file per uri
+    assert not os.path.exists(first.path)
+    assert len(first) == 0
+    assert list(second.contains(hash_keys(emails[1:2]))) == [True]
+    os.remove(second.path)
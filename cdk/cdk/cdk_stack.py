@@ -16,6 +16,8 @@ from aws_cdk import (
     aws_events_targets as targets,
     aws_sqs as sqs,
     aws_ssm as ssm,
+    aws_dynamodb as dynamodb,
+    aws_kinesis as kinesis,
     aws_lambda_destinations as destinations,
     Aspects,
     CfnTag as tag
@@ -56,6 +58,26 @@ class CdkStack(Stack):
         self.lambda_script_name = self.node.try_get_context("lambda_script_name")
         self.glue_job_script = self.node.try_get_context("glue_job_script")
         self.glue_job_name = self.node.try_get_context("glue_job_name")
+        # object size thresholds in bytes used by the lambda to route incoming objects
+        self.routing_small_object_max_bytes = self.node.try_get_context("routing_small_object_max_bytes") or 1048576
+        self.routing_large_object_min_bytes = self.node.try_get_context("routing_large_object_min_bytes") or 104857600
+        self.routing_large_object_workers = self.node.try_get_context("routing_large_object_workers") or 4
+        # SQS buffer between the eventbridge rule and the lambda, concurrency cap keeps uploads under meta rate limits
+        self.ingestion_batch_size = self.node.try_get_context("ingestion_batch_size") or 10
+        self.ingestion_max_batching_window_seconds = self.node.try_get_context("ingestion_max_batching_window_seconds") or 30
+        self.ingestion_max_concurrency = self.node.try_get_context("ingestion_max_concurrency") or 2
+        # csv or ndjson pre-encoded event lines written by the glue job
+        self.glue_output_format = self.node.try_get_context("glue_output_format") or "csv"
+        # glue job uploads directly from the executors when enabled instead of writing csv files for the lambda
+        self.glue_direct_upload = self.node.try_get_context("glue_direct_upload") or "false"
+        self.glue_direct_upload_target = self.node.try_get_context("glue_direct_upload_target") or "conversions"
+        self.glue_direct_upload_events_per_second = self.node.try_get_context("glue_direct_upload_events_per_second") or 0
+        # partitions the upload is coalesced to, caps concurrent upload tasks, 0 uses the parallelism at job start
+        self.glue_direct_upload_concurrency = self.node.try_get_context("glue_direct_upload_concurrency") or 0
+        # kinesis stream and lambda for real time conversions, sent within seconds instead of through s3 objects
+        self.streaming_ingestion_enabled = str(self.node.try_get_context("streaming_ingestion_enabled") or "false").lower() == "true"
+        self.streaming_batch_size = self.node.try_get_context("streaming_batch_size") or 500
+        self.streaming_max_batching_window_seconds = self.node.try_get_context("streaming_max_batching_window_seconds") or 1
         # Sets a customer managed key as best practise. Customer managed keys comes with higher costs compared to AWS managed.
         self.set_kms_key()
         self.role_name = "cleanroom_meta_upload_role"
@@ -126,6 +148,12 @@ class CdkStack(Stack):
         self.add_lambda_layers()
         self.add_lambda_function()
 
+        # shared rate limit of all concurrent lambda invocations
+        self.add_rate_limit_table()
+
+        if self.streaming_ingestion_enabled:
+            self.add_streaming_ingestion()
+
         # lambda function needs to be created before creating event setup
         self.add_event_framework()
 
@@ -380,7 +408,14 @@ class CdkStack(Stack):
             "--sourcetable": self.glue_source_table_name,
             "--targettable": self.glue_target_table_name,
             "--targetcatalogdb": self.glue_catalog_target_db_name,
-            "--targetcatalogtable": self.glue_catalog_target_table_name
+            "--targetcatalogtable": self.glue_catalog_target_table_name,
+            "--extra-py-files": f"s3://{self.cdk_asset_bucket.bucket_name}/{self.glue_script_bucket_key}/meta_direct_upload.py",
+            "--outputformat": self.glue_output_format,
+            "--directupload": str(self.glue_direct_upload).lower(),
+            "--directuploadtarget": self.glue_direct_upload_target,
+            "--eventspersecond": str(self.glue_direct_upload_events_per_second),
+            "--uploadconcurrency": str(self.glue_direct_upload_concurrency),
+            "--configpath": f"/{self.parameter_prefix}/"
         }
         # add security configuration to meet cdk-nag bar
         glue_sec_config = glue.CfnSecurityConfiguration(
@@ -498,11 +533,76 @@ class CdkStack(Stack):
         )
         CfnOutput(self, "Lambda_Function", value=self.meta_converstions_lambda.function_arn)
 
+    def add_rate_limit_table(self) -> None:
+        """
+        Creates the DynamoDB table holding the token buckets shared by all concurrent lambda invocations
+        The lambda only uses it when rate_limit.events_per_second is set in the config
+        """
+        self.rate_limit_table = dynamodb.Table(
+            self,
+            "metaUploadRateLimit",
+            partition_key=dynamodb.Attribute(name="bucket_key", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            encryption=dynamodb.TableEncryption.CUSTOMER_MANAGED,
+            encryption_key=self.kms_key,
+            point_in_time_recovery=True,
+            removal_policy=RemovalPolicy.DESTROY,
+        )
+        self.rate_limit_table.grant_read_write_data(self.meta_converstions_lambda)
+        self.meta_converstions_lambda.add_environment("RATE_LIMIT_TABLE_NAME", self.rate_limit_table.table_name)
+        CfnOutput(self, "Rate_Limit_Table", value=self.rate_limit_table.table_name)
+
+    def add_streaming_ingestion(self) -> None:
+        """
+        Creates the kinesis stream of real time conversions and the lambda consuming it in micro-batches
+        Each record holds one json row or a list of rows keyed by the glue job output columns
+        """
+        conversions_stream = kinesis.Stream(
+            self,
+            "metaConversionsStream",
+            encryption=kinesis.StreamEncryption.KMS,
+            encryption_key=self.kms_key,
+            retention_period=Duration.hours(24),
+        )
+        stream_lambda = _lambda.Function(
+            self,
+            "metaConversionsStreamPublish",
+            function_name="metaConversionsStreamPublish",
+            runtime=self.lambda_runtime,
+            handler=f"{self.lambda_script_name}.stream_handler",
+            code=_lambda.Code.from_asset(path.join(self.asset_dir, f"{self.lambda_script_bucket_key}/{self.lambda_script}/")),
+            layers=[self.fb_lambda_layer, self.wrangler_layer],
+            timeout=Duration.minutes(1),
+            role=self.role,
+            environment={"RATE_LIMIT_TABLE_NAME": self.rate_limit_table.table_name},
+        )
+        self.rate_limit_table.grant_read_write_data(stream_lambda)
+        conversions_stream.grant_read(stream_lambda)
+        _lambda.EventSourceMapping(
+            self,
+            "metaConversionsStreamEventSource",
+            target=stream_lambda,
+            event_source_arn=conversions_stream.stream_arn,
+            starting_position=_lambda.StartingPosition.LATEST,
+            batch_size=self.streaming_batch_size,
+            max_batching_window=Duration.seconds(self.streaming_max_batching_window_seconds),
+            report_batch_item_failures=True,
+            bisect_batch_on_error=True,
+            retry_attempts=3,
+        )
+        CfnOutput(self, "Conversions_Stream", value=conversions_stream.stream_name)
+        CfnOutput(self, "Stream_Lambda_Function", value=stream_lambda.function_arn)
+
     def add_event_framework(self) -> None:
         """
         Creates AWS eventbridge components to route and archive events and DLQ
         Change event pattern json as needed
+        Object size based routing thresholds are passed to the lambda, it routes each object using detail.object.size
+        Events are buffered in an SQS queue that the lambda polls in batches with capped concurrency
         """
+        self.meta_converstions_lambda.add_environment("ROUTING_SMALL_OBJECT_MAX_BYTES", str(self.routing_small_object_max_bytes))
+        self.meta_converstions_lambda.add_environment("ROUTING_LARGE_OBJECT_MIN_BYTES", str(self.routing_large_object_min_bytes))
+        self.meta_converstions_lambda.add_environment("ROUTING_LARGE_OBJECT_WORKERS", str(self.routing_large_object_workers))
         event_pattern_detail = {
                             "bucket": {
                                 "name": [f"{self.glue_target_bucket.bucket_name}"]
@@ -511,9 +611,14 @@ class CdkStack(Stack):
                                 "key": [{
                                     "prefix": self.glue_target_table_name
                                 }],
-                                "key": [{
-                                    "suffix": ".csv"
-                                }]
+                                # uncompressed, gzip and zstd compressed csv objects and ndjson event payload lines
+                                "key": [
+                                    {"suffix": ".csv"},
+                                    {"suffix": ".csv.gz"},
+                                    {"suffix": ".csv.zst"},
+                                    {"suffix": ".ndjson.gz"},
+                                    {"suffix": ".txt.gz"}
+                                ]
                             }
                         }
         rule = events.Rule(self, "meta_upload_s3_object_create",
@@ -523,6 +628,42 @@ class CdkStack(Stack):
                         detail=event_pattern_detail
                     )
                 )
-        
-        rule.add_target(targets.LambdaFunction(self.meta_converstions_lambda))
+
+        # events are buffered in SQS and polled in batches, the lambda reports failed records individually
+        # visibility timeout follows the recommended six times the lambda timeout
+        ingestion_dead_letter_queue = sqs.Queue(
+            self,
+            "metaUploadIngestionDLQ",
+            encryption=sqs.QueueEncryption.KMS,
+            encryption_master_key=self.kms_key,
+            )
+        ingestion_dead_letter_queue.add_to_resource_policy(self.get_deny_non_ssl_policy(ingestion_dead_letter_queue.queue_arn))
+        self.ingestion_queue = sqs.Queue(
+            self,
+            "metaUploadIngestionQueue",
+            encryption=sqs.QueueEncryption.KMS,
+            encryption_master_key=self.kms_key,
+            visibility_timeout=Duration.minutes(90),
+            dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=3, queue=ingestion_dead_letter_queue),
+            )
+        self.ingestion_queue.add_to_resource_policy(self.get_deny_non_ssl_policy(self.ingestion_queue.queue_arn))
+        rule.add_target(targets.SqsQueue(self.ingestion_queue))
+
+        ingestion_event_source = _lambda.EventSourceMapping(
+            self,
+            "metaUploadIngestionEventSource",
+            target=self.meta_converstions_lambda,
+            event_source_arn=self.ingestion_queue.queue_arn,
+            batch_size=self.ingestion_batch_size,
+            max_batching_window=Duration.seconds(self.ingestion_max_batching_window_seconds),
+            report_batch_item_failures=True,
+        )
+        self.ingestion_queue.grant_consume_messages(self.meta_converstions_lambda)
+        # records not started before the invocation runs out of time are sent to the queue again
+        self.ingestion_queue.grant_send_messages(self.meta_converstions_lambda)
+        # maximum concurrency is not exposed by the pinned cdk version, set through the cloudformation property
+        ingestion_event_source.node.default_child.add_property_override(
+            "ScalingConfig", {"MaximumConcurrency": self.ingestion_max_concurrency}
+        )
         CfnOutput(self, "Event_Bridge_Rule", value=rule.rule_arn)
+        CfnOutput(self, "Ingestion_Queue", value=self.ingestion_queue.queue_arn)
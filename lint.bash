@@ -12,10 +12,18 @@ echo "cleanroom-activation-meta-normalize-scriptonly.py"
 echo "**********"
 bandit ./assets/glue/cleanroom-activation-meta-normalize-scriptonly.py
 echo "**********"
+echo "meta_direct_upload.py"
+echo "**********"
+bandit ./assets/glue/meta_direct_upload.py
+echo "**********"
 echo "send_conversion_events.py"
 echo "**********"
 bandit ./assets/lambda/meta_conversions/send_conversion_events.py
 echo "**********"
+echo "suppression_index.py"
+echo "**********"
+bandit ./assets/lambda/meta_conversions/suppression_index.py
+echo "**********"
 echo "app.py"
 echo "**********"
 bandit ./cdk/app.py